@@ -6,66 +6,237 @@ Generic base class for Z->tau tau // mu mu analysis.
 '''
 
 from FinalStateAnalysis.PlotTools.MegaBase import MegaBase
+import array
+import branchUsage
+import columnar
+import histoMerge
+import itertools
+import json
+import multiprocessing
+import numpy as np
 import os
 import pprint
 import ROOT
+import time
+from regionIndex import RegionIndex
+from fillPlans import compile_fill_plans, folder_plans, make_plan
+from histoStore import BookingTemplate, ArrayHistoStore
+from profiling import Profiler
+from partialResults import PartialResults, partials_dir, sample_files
+from skimCache import SkimCache, skim_origins
+
+def option(name, default=''):
+    'analyzer options are taken from the environment (TAUEFF_<NAME>), as jobid and megatarget'
+    return os.environ.get('TAUEFF_%s' % name.upper(), default)
                         
 class TauEffBase(MegaBase):
     def __init__(self, tree, outfile, wrapper, **kwargs):
         super(TauEffBase, self).__init__(tree, outfile, **kwargs)
         # Cython wrapper class must be passed
+        self.ntuple = tree #raw TTree, used by the columnar engine
+        self.wrapper = wrapper
         self.tree = wrapper(tree)
         self.out = outfile
         self.histograms = {}
         self.is7TeV = '7TeV' in os.environ['jobid']
+        self.is_data = os.environ['megatarget'].startswith('data_')
         self.histo_locations = {} #just a mapping of the histograms we have to avoid changing self.histograms indexing an screw other files
         self.hfunc   = { #maps the name of non-trivial histograms to a function to get the proper value, the function MUST have two args (evt and weight). Used in fill_histos later
             'nTruePU' : lambda row, weight: (row.nTruePU,None),
             'weight'  : lambda row, weight: (weight,None) if weight is not None else (1.,None),
             'Event_ID': lambda row, weight: (array.array("f", [row.run,row.lumi,int(row.evt)/10**5,int(row.evt)%10**5] ), None),
             }
+        self.hfunc_array = { #same as hfunc, but acting on a whole chunk of events (columnar engine). Missing ones are computed event by event
+            'nTruePU' : lambda chunk, weights: (chunk['nTruePU'], None),
+            'weight'  : lambda chunk, weights: (weights, None),
+            }
+        #array versions of id_functions and id_functions_with_sys (same keys), used by the columnar engine
+        self.id_functions_array = {}
+        self.id_functions_with_sys_array = {}
+        #IDs declared through a regionIndex.IdTable (read once per event, packed in a bitmask)
+        self.id_table = None
+        #MC corrections: correction name --> correction, given by the subclass (load_corrections).
+        #The ones of the columnar engine are built only if it is used
+        self.correction_factory = None
+        self.array_corrections  = {}
+        #preselection declared as a baseSelections.CutFlow, whose cuts can be reordered by rejection/cost
+        self.cutflow      = None
+        self.reorder_cuts = option('reorder_cuts', '1') == '1'
+        # time stages, cuts and IDs of the event loop, written to <output>.profile.json
+        self.profiler     = Profiler() if option('profile', '0') == '1' else None
+        # cache of the preselected events (used branches only), read back by the next runs
+        self.skim          = option('skim', '0') == '1'
+        self.skim_dir      = option('skim_dir', os.path.join('skims', os.environ['jobid'], type(self).__name__))
+        self.skim_cache    = None
+        self.skim_writing  = False
+        self.skim_branches = None
+        self.skim_needed   = None
+        self.skip_preselection = False
+        self.tree_path     = type(self).tree #path of the tree in the input files
+        # read only the branches used, found calling the analysis functions on the first events.
+        # Opt-in: a branch read only behind a short-circuit (a or b, a and b) can be missed by the
+        # tracing, and a disabled branch silently keeps a stale value. Such branches MUST be listed in extra_branches
+        self.branch_filter = option('branch_filter', '0') == '1'
+        self.trace_events  = int(option('trace_events', 1000))
+        self.extra_branches = []
+        self.used_branches = None
+        # one partial result per group of input files, the groups already done are skipped
+        self.partials      = option('partials', '0') == '1'
+        self.partial_files = int(option('partial_files', 1))
+        self.partials_dir  = option('partials_dir', partials_dir(os.environ['jobid'], type(self).__name__, os.environ['megatarget']))
+        # 'rows' loops over the ntuple with the cython wrapper, 'columnar' reads it in chunks of numpy arrays
+        self.columnar   = option('engine', 'rows') == 'columnar'
+        self.chunk_size = int(option('chunk_size', 50000))
+        # number of local processes the entries are split into
+        self.workers    = int(option('workers', 1))
+        # 'root' books one ROOT histogram per folder, 'ndarray' keeps all the folders in numpy arrays
+        # and converts them to ROOT histograms when writing (needs the booking template)
+        self.histo_backend = option('histo_backend', 'root')
+        self.store         = None
+        # book the histograms of one folder once and clone them everywhere (0 calls book_histos for each folder)
+        self.book_template = option('book_template', '1') == '1' or self.histo_backend == 'ndarray'
+        # with the template, book the folders only when they receive the first entry
+        # (empty ones written only if placeholders are requested)
+        self.lazy_booking  = option('lazy_booking', '0') == '1' and self.book_template
+        self.placeholders  = option('placeholders', '0') == '1'
+        self.template      = None
+        # in the shard workers: the output file is the parent's, nothing is to be created in it
+        self.detached      = False
         self.objId = {}
         self.systematics = ['']
         self.currect_systematic = ''
 
     def fill_histos(self, histos, folder, row, weight):
-        '''fills histograms'''
-        #find all keys matching
-        folder_str = folder
-        for attr in self.histo_locations[folder_str]:
-            value = self.histograms[folder_str+'/'+attr]
-            if value.InheritsFrom('TH2'):
-                if attr in self.hfunc:
-                    result, out_weight = self.hfunc[attr](row, weight)
-                    r1, r2 = result
-                    if out_weight is None:
-                        value.Fill( r1, r2 ) #saves you when filling NTuples!
-                    else:
-                        value.Fill( r1, r2, out_weight )
+        '''fills histograms, following the plans compiled in begin()'''
+        for plan in self.fill_plans[folder]:
+            plan.fill( *plan.getter(row, weight) )
+        return None
+
+    def fill_folders(self, folders, row, weight):
+        '''fills all the folders an event belongs to, each variable is
+        computed once and shared by all the folders'''
+        fill_plans = self.fill_plans
+        values     = {}
+        for folder in folders:
+            plans = fill_plans.get(folder)
+            if plans is None:
+                plans = self.materialize(folder)
+            for plan in plans:
+                key = plan.key
+                if key in values:
+                    args = values[key]
                 else:
-                    attr1, attr2 = tuple(attr.split('#'))
-                    v1 = getattr(row,attr1)
-                    v2 = getattr(row,attr2)
-                    value.Fill( v1, v2, weight ) if weight is not None else value.Fill( v1, v2 )
+                    args = values[key] = plan.getter(row, weight)
+                plan.fill( *args )
+
+    def fill_folders_columnar(self, folder_masks, chunk, weights):
+        '''fills each folder with the entries of chunk selected by its mask.
+        Each variable is computed once for the whole chunk'''
+        fill_plans = self.fill_plans
+        values     = {}
+        for folder, mask in folder_masks.iteritems():
+            plans = fill_plans.get(folder)
+            if plans is None:
+                plans = self.materialize(folder)
+            for plan in plans:
+                key = plan.key
+                if key not in values:
+                    values[key] = columnar.as_arrays( *plan.array_getter(chunk, weights) )
+                plan_values, plan_weights = values[key]
+                columnar.fill(plan.histo, columnar.take(plan_values, mask), plan_weights[mask])
+
+    def load_corrections(self, factory, **corrections):
+        '''sets the MC corrections needed by the analyzer as attributes
+        (attribute = correction name), built by factory(name). The array
+        ones (attribute ending with _array) are left to load_array_corrections.
+        Data need none'''
+        start = time.time()
+        self.correction_factory = factory
+        for attr, name in corrections.iteritems():
+            if attr.endswith('_array'):
+                self.array_corrections[attr] = name
+                setattr(self, attr, None)
             else:
-                if attr in self.hfunc:
-                    result, out_weight = self.hfunc[attr](row, weight)
-                    if out_weight is None:
-                        value.Fill( result ) #saves you when filling NTuples!
-                    else:
-                        value.Fill( result, out_weight )
-                else:
-                    value.Fill( getattr(row,attr), weight ) if weight is not None else value.Fill( getattr(row,attr) )
-        return None
+                setattr(self, attr, None if self.is_data else factory(name))
+        if not self.is_data:
+            print 'corrections loaded in %.2f s' % (time.time() - start)
+
+    def load_array_corrections(self):
+        'builds the corrections of the columnar engine, if not yet done'
+        if self.is_data:
+            return
+        for attr, name in self.array_corrections.iteritems():
+            if getattr(self, attr) is None:
+                setattr(self, attr, self.correction_factory(name))
+
+    def timed(self, category, name, fcn):
+        'fcn, timed if profiling'
+        if self.profiler is None or fcn is None:
+            return fcn
+        return self.profiler.wrap(category, name, fcn)
 
     def count_bjets(self, row):
         return row.bjetCSVVeto
     
 
+    def systematics_plan(self):
+        '''systematics to be booked and evaluated for the current target, the
+        first one is the nominal. Data are never shifted, MC only needs the
+        shifts if some selection flag depends on them'''
+        if self.is_data or not self.id_functions_with_sys:
+            return self.systematics[:1]
+        return list(self.systematics)
+
+    def book_folders(self, folders):
+        '''books the histograms of all the folders, by cloning the ones
+        booked by book_histos for the first folder'''
+        if not self.book_template or not folders:
+            for folder in folders:
+                self.book_histos(folder) # defined in subclass
+            return
+        # the first folder is booked by MegaBase.book as usual, its histograms are the prototypes
+        already  = set(self.histograms)
+        self.book_histos(folders[0]) # defined in subclass
+        booked   = sorted(set(self.histograms) - already)
+        template = BookingTemplate([ (histoMerge.split_path(key)[1], self.histograms[key]) for key in booked ])
+        self.template = template
+        if self.histo_backend == 'ndarray':
+            self.store = ArrayHistoStore(template, folders)
+            for key in booked: #replaced by the store
+                self.histograms.pop(key).SetDirectory(0)
+            first = 0
+        else:
+            first = 1
+        if self.lazy_booking:
+            return
+        for folder in folders[first:]:
+            self.book_folder(folder)
+
+    def book_folder(self, folder):
+        'books the template histograms in folder, with the chosen backend'
+        if self.store is not None:
+            self.store.book_into(folder, self.histograms)
+        elif self.detached:
+            # the parent creates the directory when merging the shard
+            self.template.clone_into(0, folder, self.histograms)
+        else:
+            self.template.clone_into(histoMerge.get_directory(self.out, folder), folder, self.histograms)
+
+    def materialize(self, folder):
+        '''books a lazily booked folder, returns its fill plans'''
+        self.book_folder(folder)
+        self.histo_locations[folder] = [name for name, _ in self.template.prototypes]
+        self.fill_plans[folder] = folder_plans(self.histograms, folder, self.histo_locations[folder], self.hfunc, self.hfunc_array)
+        return self.fill_plans[folder]
+
     def begin(self):
+        start = time.time()
+        self.systematics = self.systematics_plan()
+        print 'systematics evaluated: %s' % ', '.join(repr(i) for i in self.systematics)
         # Loop over regions, book histograms
-        for folder in self.build_folder_structure():
-            self.book_histos(folder) # defined in subclass
+        folders = sorted(self.build_folder_structure())
+        self.book_folders(folders)
+        booked = time.time()
         for key in self.histograms:
             charpos  = key.rfind('/')
             location = key[ : charpos]
@@ -75,45 +246,421 @@ class TauEffBase(MegaBase):
             else:
                 self.histo_locations[location] = [name]
                 #pprint.pprint(self.histo_locations) 
+        # Resolve once how each histogram is filled
+        self.fill_plans = compile_fill_plans(self.histograms, self.histo_locations, self.hfunc, self.hfunc_array)
+        # Compile the region selections into bit masks
+        self.region_index = RegionIndex(self.build_folder_structure(), self.systematics, int(option('route_cache_size', 4096)))
+        id_table_names = self.id_table.names if self.id_table is not None else []
+        missing = set(self.region_index.flags) - set(self.id_functions) - set(self.id_functions_with_sys) - set(id_table_names)
+        if missing:
+            raise KeyError('no function defined for the selection flags: %s' % ', '.join(sorted(missing)))
+        self.declared_folders = folders
+        if self.skim:
+            self.setup_skim()
+        if self.columnar: #known only now, writing the skim switches to it
+            self.load_array_corrections()
+        if self.branch_filter:
+            self.enable_used_branches()
+        if self.cutflow is not None:
+            for cut in self.cutflow.cuts:
+                cut.row   = self.timed('cut', cut.name, cut.row)
+                cut.array = self.timed('cut_array', cut.name, cut.array)
+        print 'startup: booked %i histograms in %i folders in %.2f s, begin() took %.2f s%s' % \
+            (len(self.histograms), len(folders), booked - start, time.time() - start,
+             ' (lazy booking)' if self.lazy_booking else '')
+        if self.store is not None:
+            print 'ndarray histogram store: %.1f MB' % (self.store.nbytes()/1024.**2)
+
+    def setup_skim(self):
+        '''reads the preselected events from the skim cache if complete and
+        holding all the branches needed, otherwise gets ready to write it'''
+        self.skim_cache  = SkimCache(self.skim_dir, os.environ['megatarget'], self, self.input_files())
+        self.skim_needed = self.traced_branches(preselection=False)
+        stored           = self.skim_cache.branches()
+        if stored is not None and not set(self.skim_needed) <= set(stored):
+            print 'skim: %s lacks the branches %s, writing it again' % \
+                (self.skim_cache.path, ', '.join(sorted(set(self.skim_needed) - set(stored))))
+        elif stored is not None:
+            print 'skim: reading the preselected events from %s' % self.skim_cache.path
+            self.ntuple    = self.skim_cache.open()
+            self.tree      = self.wrapper(self.ntuple)
+            self.tree_path = SkimCache.tree_name
+            self.skip_preselection = True
+            return
+        print 'skim: writing the preselected events to %s' % self.skim_cache.path
+        self.skim_writing = True
+        if not self.columnar:
+            print 'skim: the cache is written by the columnar engine, switching to it'
+            self.columnar = True
+
+    def branch_calls(self, preselection=True):
+        '''functions(row) calling everything reading the ntuple: the cuts
+        (all of them, if preselection), IDs for each systematic, event
+        weight and histogram values'''
+        calls = []
+        if self.skip_preselection or not preselection: #reading the skim, the cuts were applied
+            pass
+        elif self.cutflow is not None:
+            calls.extend(cut.row for cut in self.cutflow.cuts)
+        else:
+            calls.append(self.preselection)
+        calls.extend(self.id_functions.itervalues())
+        for systematic in self.systematics:
+            calls.extend( (lambda fcn, systematic: lambda row: fcn(row, systematic))(fcn, systematic)
+                          for fcn in self.id_functions_with_sys.itervalues() )
+        plans = [plan for plans in self.fill_plans.itervalues() for plan in plans]
+        if self.template is not None: #lazily booked folders have no plans yet
+            plans += [ make_plan(proto, name, self.hfunc, self.hfunc_array) for name, proto in self.template.prototypes ]
+        getters = dict( (plan.key, plan.getter) for plan in plans ).values()
+        def fill_values(row):
+            weight = self.event_weight(row)
+            for getter in getters:
+                getter(row, weight)
+        calls.append(fill_values)
+        return calls
+
+    def traced_branches(self, preselection=True):
+        '''the branches read on the first events, plus the declared ones
+        (extra_branches, IDs of the table)'''
+        rows = self.iter_rows(0, min(self.trace_events, self.ntuple.GetEntries()))
+        used = branchUsage.trace_branches(rows, self.branch_calls(preselection))
+        used.update(self.extra_branches)
+        if self.id_table is not None:
+            used.update(self.id_table.branches)
+        return branchUsage.existing_branches(self.ntuple, used)
+
+    def enable_used_branches(self):
+        'traces the branches used on the first events and disables the others'
+        self.used_branches = self.traced_branches()
+        branchUsage.enable_only(self.ntuple, self.used_branches)
+        print 'branches: reading %i out of %i' % (len(self.used_branches), self.ntuple.GetListOfBranches().GetEntries())
+
+    def discover_branches(self):
+        '''columnar dry run over the first chunk: returns the branches read
+        by everything following the preselection'''
+        chunk = next(columnar.iter_chunks(self.ntuple, self.chunk_size), None)
+        if chunk is None:
+            return []
+        index = self.region_index
+        _, id_words, id_names = self.compile_id_table()
+        id_words(chunk)
+        for name, _ in index.flags_in(self.id_functions, id_names):
+            columnar.evaluate(chunk, self.id_functions[name], self.id_functions_array.get(name))
+        for systematic in self.systematics:
+            for name, _ in index.flags_in(self.id_functions_with_sys, set(self.id_functions) | set(id_names)):
+                columnar.evaluate(chunk, self.id_functions_with_sys[name], self.id_functions_with_sys_array.get(name), (systematic,))
+        weights = columnar.evaluate(chunk, self.event_weight, getattr(self, 'event_weight_array', None), dtype=np.float64)
+        plans = [plan for plans in self.fill_plans.itervalues() for plan in plans]
+        if self.template is not None: #lazily booked folders have no plans yet
+            plans += [ make_plan(proto, name, self.hfunc, self.hfunc_array) for name, proto in self.template.prototypes ]
+        for plan in plans:
+            plan.array_getter(chunk, weights)
+        return sorted(chunk.columns)
 
     def process(self):
-        # For speed, map the result of the region cuts to a folder path
-        # string using a dictionary
-        # key = (sign, obj1, obj2, obj3)
-        cut_region_map = self.build_folder_structure()
+        nentries = self.ntuple.GetEntries()
+        start    = time.time()
+        if self.skim_writing:
+            self.skim_branches = sorted( set(self.discover_branches()) | set(self.skim_needed) )
+            self.skim_cache.prepare()
+        if self.partials:
+            self.process_by_file()
+        else:
+            self.process_range(0, nentries)
+        if self.skim_writing:
+            self.skim_cache.seal(self.skim_branches)
+        if self.profiler is not None:
+            self.profiler.wall += time.time() - start
+
+    def process_range(self, start, stop):
+        if self.workers > 1:
+            self.process_sharded(start, stop)
+        else:
+            self.process_entries(start, stop)
+
+    def file_ranges(self):
+        '(path, start, stop) of the entries of each input file'
+        tree  = self.ntuple
+        files = self.input_files()
+        if not tree.InheritsFrom('TChain'):
+            return [(files[0], 0, tree.GetEntries())]
+        tree.GetEntries() #loads all the trees, filling the offsets
+        offsets = tree.GetTreeOffset()
+        return [ (path, offsets[i], offsets[i + 1]) for i, path in enumerate(files) ]
+
+    def reset_histograms(self):
+        for histo in self.histograms.itervalues():
+            histo.Reset()
+
+    def process_by_file(self):
+        '''processes the input files in groups, writing the histograms of
+        each group to its own partial file, then sums all of them. The
+        groups with a partial file from a previous run are skipped'''
+        partials = PartialResults(self.partials_dir)
+        partials.prepare()
+        groups   = partials.groups(self.file_ranges(), self.partial_files)
+        #mega may split the sample among several instances: only the files of this one are ours.
+        #Partials of skim parts (of any instance) are compared through the inputs the skims were made from
+        own_files = self.skim_cache.inputs if self.skip_preselection else self.input_files()
+        partials.remove_stale([key for key, _, _, _ in groups], own_files,
+                              sample_files(os.environ['jobid'], os.environ['megatarget']),
+                              skim_origins(self.skim_dir, os.environ['megatarget']))
+        for key, start, stop, paths in groups:
+            if partials.done(key) and not self.skim_writing: #the skim needs all the events
+                print 'partials: entries [%i, %i) already processed' % (start, stop)
+                continue
+            self.reset_histograms()
+            self.process_range(start, stop)
+            partials.record(key, paths)
+            histoMerge.write_histograms(self.histograms, partials.path(key))
+        self.reset_histograms()
+        for key, _, _, _ in groups:
+            histoMerge.add_histograms(self.histograms, partials.path(key), self.materialize)
+        print 'partials: %i merged from %s' % (len(groups), partials.directory)
+
+    def process_entries(self, start, stop):
+        'processes the entries [start, stop) with the chosen engine'
+        if self.profiler is not None:
+            self.profiler.events += stop - start
+        if self.columnar:
+            self.process_columnar(start, stop)
+        else:
+            self.process_rows(self.iter_rows(start, stop))
+
+    def iter_rows(self, start, stop):
+        'rows of the entries [start, stop) through the cython wrapper'
+        if start == 0 and stop >= self.ntuple.GetEntries():
+            return iter(self.tree)
+        if hasattr(self.tree, 'load_entry'):
+            def _rows():
+                for entry in xrange(start, stop):
+                    self.tree.load_entry(entry)
+                    yield self.tree
+            return _rows()
+        return itertools.islice(iter(self.tree), start, stop) #slower, skipped entries are loaded anyway
+
+    def input_files(self):
+        tree = self.ntuple
+        if tree.InheritsFrom('TChain'):
+            return [element.GetTitle() for element in tree.GetListOfFiles()]
+        return [tree.GetCurrentFile().GetName()]
+
+    def reopen_input(self):
+        '''re-opens the input files, so that a forked process does not share
+        the file descriptors (and their offsets) with its parent'''
+        chain = ROOT.TChain(self.tree_path)
+        for path in self.input_files():
+            chain.Add(path)
+        if self.used_branches is not None:
+            branchUsage.enable_only(chain, self.used_branches)
+        self.ntuple = chain
+        self.tree   = self.wrapper(chain)
+
+    def process_sharded(self, start, stop):
+        '''splits the entries [start, stop) among self.workers local processes,
+        each filling its own copy of the histograms, which are summed back'''
+        bounds      = [ start + (stop - start)*i/self.workers for i in range(self.workers + 1) ]
+        shard_files = [ '%s.shard%i.root' % (self.out.GetName(), i) for i in range(1, self.workers) ]
+        workers     = []
+        for shard_file, first, last in zip(shard_files, bounds[1:-1], bounds[2:]):
+            worker = multiprocessing.Process(target=self.process_shard, args=(first, last, shard_file))
+            worker.start()
+            workers.append(worker)
+        # this process takes care of the first shard
+        self.process_entries(bounds[0], bounds[1])
+        for worker in workers:
+            worker.join()
+        if any(worker.exitcode for worker in workers):
+            raise RuntimeError('%i worker(s) out of %i failed' % (len([i for i in workers if i.exitcode]), len(workers)))
+        for shard_file in shard_files:
+            histoMerge.add_histograms(self.histograms, shard_file, self.materialize)
+            os.remove(shard_file)
+            if self.profiler is not None:
+                self.profiler.merge(shard_file + '.profile.json')
+                os.remove(shard_file + '.profile.json')
+            self.merge_counters(shard_file + '.counters.json')
+            os.remove(shard_file + '.counters.json')
+
+    def process_shard(self, start, stop, path):
+        'runs in the worker processes'
+        self.detached = True
+        self.reopen_input()
+        self.process_entries(start, stop)
+        histoMerge.write_histograms(self.histograms, path)
+        if self.profiler is not None:
+            self.profiler.dump(path + '.profile.json')
+        self.dump_counters(path + '.counters.json')
+
+    def dump_counters(self, path):
+        'stores the cut flow and routing cache counters, for the parent process to sum'
+        counters = {'region_index' : self.region_index.counters()}
+        if self.cutflow is not None:
+            counters['cutflow'] = self.cutflow.counters()
+        with open(path, 'w') as output:
+            json.dump(counters, output, indent=2, sort_keys=True)
+
+    def merge_counters(self, path):
+        with open(path) as stored:
+            counters = json.load(stored)
+        self.region_index.add_counters(counters['region_index'])
+        if self.cutflow is not None:
+            self.cutflow.add_counters(counters['cutflow'])
+
+    def compile_id_table(self):
+        '''returns the (row, chunk) functions giving the word of the IDs in
+        the table and the names of these IDs'''
+        index = self.region_index
+        if self.id_table is None:
+            return (lambda row: 0), (lambda chunk: 0), ()
+        flag_bits = dict( index.flags_in(self.id_table.masks) )
+        row_word, array_word = self.id_table.compile(flag_bits)
+        return row_word, array_word, self.id_table.names
+
+    def array_evaluator(self, category, name, row_fcn, array_fcn, dtype=bool):
+        'chunk(, args) --> evaluation of the function over the chunk, timed'
+        return self.timed(category, name, lambda chunk, *args: columnar.evaluate(chunk, row_fcn, array_fcn, args, dtype))
+
+    def compile_sys_words(self, flag_bits):
+        '''flag_bits is {systematic dependent flag : region bit}. Returns the
+        (row, chunk) functions giving the word of these flags for each
+        systematic: a tuple for a row, a list of arrays for a chunk.
+        Analyzers can override it to evaluate all the shifts at once'''
+        systematics = self.systematics
+        encode      = self.region_index.encode_array
+        functions   = self.id_functions_with_sys
+        row_flags   = [ (bit, self.timed('sys_id', name, functions[name])) for name, bit in sorted(flag_bits.iteritems()) ]
+        array_flags = [ (bit, self.array_evaluator('sys_id', name, functions[name], self.id_functions_with_sys_array.get(name)))
+                        for name, bit in sorted(flag_bits.iteritems()) ]
+
+        def row_words(row):
+            words = []
+            for systematic in systematics:
+                word = 0
+                for bit, fcn in row_flags:
+                    if fcn(row, systematic):
+                        word |= bit
+                words.append(word)
+            return tuple(words)
+
+        def array_words(chunk):
+            return [ encode([ (bit, flag(chunk, systematic)) for bit, flag in array_flags ], len(chunk)) for systematic in systematics ]
+
+        return row_words, array_words
+
+    def sys_flag_bits(self, id_names):
+        'the systematic dependent flags to evaluate (constant ones with the same name take precedence)'
+        return dict( self.region_index.flags_in(self.id_functions_with_sys, set(self.id_functions) | set(id_names)) )
+
+    def process_rows(self, rows):
+        # For speed, the result of the region cuts is packed into an integer
+        # (one bit per flag) and matched against the compiled folder masks
+        index        = self.region_index
 
         # Reduce number of self lookups and get the derived functions here
-        histos       = self.histograms
-        preselection = self.preselection
+        timed        = self.timed
+        preselection = timed('stage', 'preselection', self.cutflow if self.cutflow is not None else self.preselection)
+        if self.skip_preselection: #reading the skim
+            preselection = lambda row: True
         id_functions = self.id_functions
-        id_functions_with_sys = self.id_functions_with_sys
-        fill_histos  = self.fill_histos
-        weight_func  = self.event_weight
-        systematics  = self.systematics
+        fill_folders = timed('stage', 'fill', self.fill_folders)
+        weight_func  = timed('stage', 'event_weight', self.event_weight)
+        route_event  = timed('stage', 'routing', index.route_event)
+
+        #IDs of the table first, then constant flags, they take precedence over the systematic ones with the same name
+        id_word, _, id_names = self.compile_id_table()
+        id_word        = timed('id', 'id_table', id_word) if self.id_table is not None else id_word
+        constant_flags = [ (bit, timed('id', name, id_functions[name])) for name, bit in index.flags_in(id_functions, id_names) ]
+        sys_words_of, _ = self.compile_sys_words( self.sys_flag_bits(id_names) )
 
-        for row in self.tree:
+        for row in rows:
             # Apply basic preselection
             if not preselection(row):
                 continue
 
-            constant_id_map = dict( [ (name, fcn(row) )  for name, fcn in id_functions.iteritems()] )
-            for systematic in systematics:
-                sys_id_map = dict( [ (name, fcn(row, systematic) )  for name, fcn in id_functions_with_sys.iteritems()] )
-                sys_id_map.update(constant_id_map)
-                # Get the generic event weight
-                event_weight = weight_func(row)
-
-                # Figure out which folder/region we are in, multiple regions allowed
-                for folder, selection in cut_region_map.iteritems():
-                    if folder.startswith(systematic): #Folder name starts with the systematic (if there are any)
-                        ## if 'QCD' in folder:
-                        ##     print folder, [ (name,(sys_id_map[name] == info )) for name, info in selection.iteritems() ]
-                        if all( [ (sys_id_map[name] == info ) for name, info in selection.iteritems() ] ):
-                            #all cuts match the one of the region, None means the cut is not needed
-                            fill_histos(histos, folder, row, event_weight)
+            constant_word = id_word(row)
+            for bit, fcn in constant_flags:
+                if fcn(row):
+                    constant_word |= bit
+            # Only the systematic dependent flags are evaluated for each shift
+            sys_words = sys_words_of(row)
+
+            # Figure out which folder/region we are in, multiple regions allowed
+            folders = route_event(constant_word, sys_words)
+            if folders:
+                # Get the generic event weight, it does not depend on the systematic
+                fill_folders(folders, row, weight_func(row))
+
+    def process_columnar(self, start, stop):
+        '''same as process_rows, but every step acts on a chunk of events
+        at once. Functions without an array version (*_array) are evaluated
+        event by event, the output is the same in both cases'''
+        index              = self.region_index
+        timed              = self.timed
+        evaluator          = self.array_evaluator
+        preselection       = evaluator('stage', 'preselection', self.preselection,
+                                       self.cutflow.array if self.cutflow is not None else getattr(self, 'preselection_array', None))
+        if self.skip_preselection: #reading the skim
+            preselection   = lambda chunk: np.ones(len(chunk), dtype=bool)
+        skim_writer        = None
+        if self.skim_writing:
+            skim_writer    = columnar.SkimWriter(self.skim_cache.part_path(start), self.ntuple, self.skim_branches, SkimCache.tree_name)
+        event_weight_of    = evaluator('stage', 'event_weight', self.event_weight, getattr(self, 'event_weight_array', None), np.float64)
+        id_functions       = self.id_functions
+        fill_folders       = timed('stage', 'fill', self.fill_folders_columnar)
+        match_array        = timed('stage', 'routing', index.match_array)
+        systematics        = self.systematics
+        _, id_words, id_names = self.compile_id_table()
+        id_words           = timed('id', 'id_table', id_words) if self.id_table is not None else id_words
+        constant_flags     = [ (bit, evaluator('id', name, id_functions[name], self.id_functions_array.get(name)))
+                               for name, bit in index.flags_in(id_functions, id_names) ]
+        _, sys_words_of    = self.compile_sys_words( self.sys_flag_bits(id_names) )
+
+        for chunk in columnar.iter_chunks(self.ntuple, self.chunk_size, start, stop):
+            # Apply basic preselection
+            chunk = chunk.select( preselection(chunk) )
+            if skim_writer is not None:
+                skim_writer.add(chunk)
+            if not len(chunk):
+                continue
+
+            constant_words = index.encode_array([ (bit, flag(chunk)) for bit, flag in constant_flags ], len(chunk)) | id_words(chunk)
+            # The event weight does not depend on the systematic
+            event_weight = event_weight_of(chunk)
+            folder_masks = {}
+            for systematic, words in zip(systematics, sys_words_of(chunk)):
+                folder_masks.update( match_array(systematic, constant_words | words) )
+
+            fill_folders(folder_masks, chunk, event_weight)
+        if skim_writer is not None:
+            skim_writer.close()
 
     def finish(self):
+        print self.region_index.report()
+        if self.cutflow is not None:
+            print self.cutflow.table()
+        if self.lazy_booking:
+            empty = [folder for folder in self.declared_folders if folder not in self.fill_plans]
+            print 'lazy booking: %i folders out of %i never filled%s' % \
+                (len(empty), len(self.declared_folders), ', writing empty placeholders' if self.placeholders else '')
+            if self.placeholders:
+                for folder in empty:
+                    self.materialize(folder)
         self.write_histos()
+        if self.profiler is not None:
+            print self.profiler.report()
+            self.profiler.dump(os.path.splitext(self.out.GetName())[0] + '.profile.json')
+
+    def write_histos(self):
+        if self.store is not None:
+            # converted and written one by one, not to hold all the ROOT histograms at once
+            for key, histo in self.histograms.iteritems():
+                location, name = histoMerge.split_path(key)
+                histoMerge.get_directory(self.out, location).WriteTObject(histo.as_root(), name)
+            self.histograms = {}
+        if self.lazy_booking:
+            # the plotter takes the histograms missing in these folders as empty, and only in these
+            self.out.WriteTObject(ROOT.TObjString('\n'.join(self.declared_folders)), 'declared_folders')
+        super(TauEffBase, self).write_histos()
 
 if __name__ == "__main__":
     import pprint
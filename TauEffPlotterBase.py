@@ -21,6 +21,7 @@ from FinalStateAnalysis.PlotTools.HistToTGRaphErrors import HistToTGRaphErrors,
 from FinalStateAnalysis.PlotTools.InflateErrorView import InflateErrorView
 from FinalStateAnalysis.MetaData.data_styles import data_styles
 from FinalStateAnalysis.StatTools.quad import quad
+from FinalStateAnalysis.PlotTools.decorators import memo
 from pdb import set_trace
 #from FinalStateAnalysis.Utilities.shelve_wrapper  import make_shelf
 import json
@@ -44,6 +45,58 @@ ROOT.gStyle.SetOptStat(0)
 def remove_name_entry(dictionary):
     return dict( [ i for i in dictionary.iteritems() if i[0] != 'name'] )
 
+@memo
+def empty_histogram(file_names, name):
+    '''empty histogram with the binning of the first histogram called name
+    found in file_names'''
+    for file_name in file_names:
+        tfile = rootpy.io.root_open(file_name)
+        for path, dirs, objects in tfile.walk():
+            if name in objects:
+                histo = tfile.Get(os.path.join(path, name)).Clone()
+                histo.SetDirectory(0)
+                histo.Reset()
+                tfile.Close()
+                return histo
+        tfile.Close()
+    raise rootpy.io.DoesNotExist('%s not found in any of %s' % (name, ', '.join(file_names)))
+
+@memo
+def declared_folders(file_names):
+    '''folders declared by the analyzer in any of file_names (written with
+    lazy booking only, as the list of folders they may miss)'''
+    ret = set()
+    for file_name in file_names:
+        tfile = rootpy.io.root_open(file_name)
+        try:
+            listing = tfile.Get('declared_folders')
+        except rootpy.io.DoesNotExist:
+            listing = None
+        if listing is not None:
+            ret.update( folder.strip('/') for folder in str(listing.GetString()).split('\n') )
+        tfile.Close()
+    return frozenset(ret)
+
+class MissingAsEmptyView(object):
+    '''Stands for the ROOT file of one sample: returns an empty histogram
+    for the paths missing in it, if their folder was declared by the
+    analyzer that made the file (with lazy booking, folders that never got
+    an entry are not written). Anything else missing (wrong path or
+    systematic, failed job) still raises. The binning of the empty
+    histograms is taken from binning_files'''
+    def __init__(self, tfile, file_name, binning_files):
+        self.tfile         = tfile
+        self.file_name     = file_name
+        self.binning_files = tuple(binning_files)
+
+    def Get(self, path):
+        try:
+            return self.tfile.Get(path)
+        except rootpy.io.DoesNotExist:
+            if os.path.dirname(path).strip('/') not in declared_folders( (self.file_name,) ):
+                raise
+            return empty_histogram(self.binning_files, os.path.basename(path)).Clone()
+
 def get_histo_integral(histo):
     nbins = histo.GetNbinsX()
     hclone = histo.Clone()
@@ -56,6 +109,7 @@ class TauEffPlotterBase(Plotter):
         jobid = self.jobid
         self.samples = [ os.path.split(i)[1].split('.')[0] for i in glob.glob('results/%s/TauEffZ%s/*.root' % (jobid, channel))]
         self.sample_file = glob.glob('results/%s/TauEffZ%s/*.root' % (jobid, channel))[0] #keep one file name, you will need it
+        self.sample_files = glob.glob('results/%s/TauEffZ%s/*.root' % (jobid, channel)) #where to look for the binning of missing histograms
         self.channel = channel
         self.period = '7TeV' if '7TeV' in jobid else '8TeV'
         self.sqrts = 7 if '7TeV' in jobid else 8
@@ -68,6 +122,7 @@ class TauEffPlotterBase(Plotter):
         self.base_out_dir = self.outputdir
         #pprint.pprint(files)
         super(TauEffPlotterBase, self).__init__(files, lumifiles, self.outputdir, blinder=None)
+        self.missing_as_empty()
         self.mc_samples = filter(lambda x: not x.startswith('data_'), self.samples)
         self.zero_systematics_point = 'NOSYS' if channel=='MT' else ''
         self.systematic = ''
@@ -83,14 +138,29 @@ class TauEffPlotterBase(Plotter):
             'ZZ*' : 'zz',
         }
 
+    def missing_as_empty(self):
+        '''puts a MissingAsEmptyView under the views of each sample file,
+        below the style, scale and sum (data) views: a folder missing in one
+        of the summed files does not hide the entries of the others'''
+        for sample, info in self.views.iteritems():
+            view = info['view']
+            while isinstance(getattr(view, 'dir', None), views._FolderView):
+                view = view.dir
+            if not isinstance(getattr(view, 'dir', None), ROOT.TFile): #sums of other samples (data)
+                continue
+            view.dir = MissingAsEmptyView(view.dir, view.dir.GetName(), self.sample_files)
+
     def get_view(self, *args): #Is it against Liskov Substitution Principle? I don't care
         if self.systematic != '':
             toget = self.systematic
             if args[0] == 'data' or (not self.systematic.endswith('es_p')):
                 toget = self.zero_systematic
             return views.SubdirectoryView( super(TauEffPlotterBase, self).get_view(*args), toget)
-        else:
-            return super(TauEffPlotterBase, self).get_view(*args)
+        return super(TauEffPlotterBase, self).get_view(*args)
+
+    def get_full_path_view(self, *args):
+        'view with the paths starting from the top of the files (systematic folder included)'
+        return super(TauEffPlotterBase, self).get_view(*args)
 
     def set_subdir(self, folder):
         self.outputdir = '/'.join([self.base_out_dir, folder])
@@ -190,7 +260,7 @@ class TauEffPlotterBase(Plotter):
         #take only the ones that we are interested in 
         histos = [i for i in histos if variable in i]
         #all the histograms have the same number of bins, store it
-        nbins  = self.views['data']['view'].Get(histos[0]).GetNbinsX()
+        nbins  = self.get_full_path_view('data').Get(histos[0]).GetNbinsX()
         #remove the trailing directory (systematics)
         if self.zero_systematics_point:
             print 'chopping away the first dir'
@@ -567,8 +567,8 @@ if not options.no_json:
 
 
 
-integral_ss = sum([plotter.views['data']['view'].Get('NOSYS/QCD/ss/%s/mPt' % m).Integral() for m in ['LoMT']])
-integral_os = sum([plotter.views['data']['view'].Get('NOSYS/QCD/os/%s/mPt' % m).Integral() for m in ['LoMT']])
+integral_ss = sum([plotter.get_full_path_view('data').Get('NOSYS/QCD/ss/%s/mPt' % m).Integral() for m in ['LoMT']])
+integral_os = sum([plotter.get_full_path_view('data').Get('NOSYS/QCD/os/%s/mPt' % m).Integral() for m in ['LoMT']])
 ratio_ss_os = integral_ss/integral_os
 
 print '(ss = %.1f +- %.1f) / (os = %.1f +- %.1f) = %.4f +- %.4f' % (integral_ss, math.sqrt(integral_ss), integral_os, math.sqrt(integral_os), ratio_ss_os, ratio_ss_os*quad(1./math.sqrt(integral_ss)+1./math.sqrt(integral_os)))
@@ -9,10 +9,11 @@ Author: Mauro Verzetti, UniZh
 import MuMuTree
 from TauEffBase import TauEffBase
 from FinalStateAnalysis.PlotTools.decorators import memo
-import mcCorrectors
 import baseSelections as selections
 import glob
+import mcCorrectors
 import os
+import numpy as np
 import ROOT
 
 @memo
@@ -27,7 +28,13 @@ class TauEffZMM(TauEffBase):
     tree = 'mm/final/Ntuple'
     def __init__(self, tree, outfile, **kwargs):
         super(TauEffZMM, self).__init__(tree, outfile,MuMuTree.MuMuTree, **kwargs)
-        self.pucorrector = mcCorrectors.make_puCorrector('singlemu')
+        self.load_corrections(mcCorrectors.get,
+            pucorrector                  = 'pu_singlemu',
+            pucorrector_array            = 'pu_singlemu_array',
+            muon_sf                      = 'muon_sf_id_iso', #PFTight x Iso
+            muon_pog_IsoMu24eta2p1       = 'muon_pog_IsoMu24eta2p1',
+            muon_pog_IsoMu24eta2p1_array = 'muon_pog_IsoMu24eta2p1_array',
+            )
         self.objId = [
             'h2Tau', 
             ]
@@ -38,9 +45,38 @@ class TauEffZMM(TauEffBase):
         
         self.id_functions_with_sys = {
             }
+
+        #preselection, the cuts are evaluated in order of rejection/cost
+        def trigger_match(name):
+            return lambda row: bool(getattr(row, name+'MatchesIsoMu24eta2p1') and \
+                (getattr(row, name+'Pt') > 25) and (getattr(row, name+'AbsEta') < 2.1))
+        def trigger_match_array(chunk, name):
+            return (chunk[name+'MatchesIsoMu24eta2p1'] != 0) & \
+                (chunk[name+'Pt'] > 25) & (chunk[name+'AbsEta'] < 2.1)
+        m1matches, m2matches = trigger_match('m1'), trigger_match('m2')
+        cuts  = [ selections.flag_cut('isoMu24eta2p1Pass') ]
+        cuts += selections.muSelection_cuts('m1', 10)
+        cuts += selections.muSelection_cuts('m2', 10)
+        cuts += [ selections.Cut('m1 | m2 matches IsoMu24eta2p1',
+                                 lambda row: m1matches(row) or m2matches(row),
+                                 lambda chunk: trigger_match_array(chunk, 'm1') | trigger_match_array(chunk, 'm2')),
+                  selections.Cut('m1 ID & Iso', lambda row: selections.mu_idIso(row, 'm1'), lambda chunk: selections.mu_idIso_array(chunk, 'm1')) ]
+        cuts += selections.vetos_cuts()
+        self.cutflow = selections.CutFlow(cuts, reorder=self.reorder_cuts)
+        #read only behind a short-circuit, the branch filter could miss them
+        self.extra_branches = ['m1MatchesIsoMu24eta2p1', 'm2MatchesIsoMu24eta2p1', 'm1RelPFIsoDBDefault', 'm2RelPFIsoDBDefault',
+                               'm1Pt', 'm1Eta', 'm2Pt', 'm2Eta']
         self.hfunc['MET_Z_perp'] = lambda row, weight: (row.type1_pfMetEt*ROOT.TMath.Cos(row.m1_m2_ToMETDPhi_Ty1), weight)
         self.hfunc['MET_Z_para'] = lambda row, weight: (row.type1_pfMetEt*ROOT.TMath.Sin(row.m1_m2_ToMETDPhi_Ty1), weight)
 
+        #array versions for the columnar engine
+        self.id_functions_array = {
+            'h2Tau'    : lambda chunk: selections.mu_idIso_array(chunk, 'm2'),
+            'sign_cut' : lambda chunk: chunk['m1_m2_SS'] == 0,
+            }
+        self.hfunc_array['MET_Z_perp'] = lambda chunk, weights: (chunk['type1_pfMetEt']*np.cos(chunk['m1_m2_ToMETDPhi_Ty1']), weights)
+        self.hfunc_array['MET_Z_para'] = lambda chunk, weights: (chunk['type1_pfMetEt']*np.sin(chunk['m1_m2_ToMETDPhi_Ty1']), weights)
+
     def build_folder_structure(self):
         flag_map = {}
         for obj_id_name in self.objId:
@@ -97,19 +133,32 @@ class TauEffZMM(TauEffBase):
         if row.run > 2:
             return 1.
         trigger_weight  = 1.
-        trigger_weight *= mcCorrectors.muon_pog_IsoMu24eta2p1(row.m1Pt, row.m1Eta) \
+        trigger_weight *= self.muon_pog_IsoMu24eta2p1(row.m1Pt, row.m1Eta) \
             if row.m1MatchesIsoMu24eta2p1 else \
             1.
-        trigger_weight *= mcCorrectors.muon_pog_IsoMu24eta2p1(row.m2Pt, row.m2Eta) \
+        trigger_weight *= self.muon_pog_IsoMu24eta2p1(row.m2Pt, row.m2Eta) \
             if row.m2MatchesIsoMu24eta2p1 else \
             1.
         return self.pucorrector(row.nTruePU)*\
-            mcCorrectors.muon_pog_PFTight(row.m1Pt, row.m1Eta) * \
-            mcCorrectors.muon_pog_Iso(row.m1Pt, row.m1Eta) * \
-            mcCorrectors.muon_pog_PFTight(row.m2Pt, row.m2Eta) * \
-            mcCorrectors.muon_pog_Iso(row.m2Pt, row.m2Eta) * \
+            self.muon_sf(row.m1Pt, row.m1Eta) * \
+            self.muon_sf(row.m2Pt, row.m2Eta) * \
             trigger_weight
 
+    def event_weight_array(self, chunk):
+        ''' Same as event_weight, on a chunk of events '''
+        is_data = chunk['run'] > 2
+        if is_data.all():
+            return 1.
+        trigger = self.muon_pog_IsoMu24eta2p1_array
+        trigger_weight  = 1.
+        trigger_weight *= np.where(chunk['m1MatchesIsoMu24eta2p1'] != 0, trigger(chunk['m1Pt'], chunk['m1Eta']), 1.)
+        trigger_weight *= np.where(chunk['m2MatchesIsoMu24eta2p1'] != 0, trigger(chunk['m2Pt'], chunk['m2Eta']), 1.)
+        weight = self.pucorrector_array(chunk['nTruePU'])*\
+            self.muon_sf.array(chunk['m1Pt'], chunk['m1Eta']) * \
+            self.muon_sf.array(chunk['m2Pt'], chunk['m2Eta']) * \
+            trigger_weight
+        return np.where(is_data, 1., weight)
+
     def sign_cut(self, row):
         return not row.m1_m2_SS
 
@@ -117,18 +166,12 @@ class TauEffZMM(TauEffBase):
         return True #row.m1MtToMET < 20 #This cut is not used in this channel
 
     def preselection(self, row):
-        ''' Preselection applied to events.
+        ''' Preselection applied to events (the cuts of self.cutflow).
 
         Excludes FR object IDs and sign cut.
         '''
-        if not row.isoMu24eta2p1Pass                : return False
-        if not selections.muSelection(row, 'm1', 10): return False
-        if not selections.muSelection(row, 'm2', 10): return False
-        m1matches = row.m1MatchesIsoMu24eta2p1 and \
-                    (row.m1Pt > 25) and (row.m1AbsEta < 2.1) 
-        m2matches = row.m2MatchesIsoMu24eta2p1 and \
-                    (row.m2Pt > 25) and (row.m2AbsEta < 2.1) 
-        if not (m1matches or m2matches):       return False
-        if not selections.mu_idIso(row, 'm1'): return False    
-        if not selections.vetos(row):          return False
-        return True
+        return self.cutflow(row)
+
+    def preselection_array(self, chunk):
+        ''' Same as preselection, on a chunk of events '''
+        return self.cutflow.array(chunk)
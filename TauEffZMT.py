@@ -8,11 +8,15 @@ Author: Mauro Verzetti, UniZh
 
 import MuTauTree
 from TauEffBase import TauEffBase
+from regionIndex import IdTable
 from FinalStateAnalysis.PlotTools.decorators import memo
-import mcCorrectors
 import baseSelections as selections
+import bisect
 import glob
+import mcCorrectors
+import operator
 import os
+import numpy as np
 import ROOT
 import itertools
 import pprint
@@ -21,21 +25,58 @@ import pprint
 def getHist(dire , name):
     return '/'.join([dire,name])
 
-sys_name_mapping = {
-    'NOSYS': '',
-    ''     : '',
-    'mes_p': 'mes',
-    'tes_p': 'tes',
-    'jes_p': 'jes',
-    'ues_p': 'ues',
+#MT branch to be used for each systematic shift
+mt_branch = {
+    'NOSYS': 'mMtToPfMet_Ty1',
+    ''     : 'mMtToPfMet_Ty1',
+    'RAW'  : 'mMtToMET',
+    'mes_p': 'mMtToPfMet_mes',
+    'tes_p': 'mMtToPfMet_tes',
+    'jes_p': 'mMtToPfMet_jes',
+    'ues_p': 'mMtToPfMet_ues',
 }
 
-@memo
-def getsysattrname(name, sys):
-    return name + '_' + sys_name_mapping[sys]
-
-def getsysattr(row, name, sys):
-    return getattr(row, getsysattrname(name, sys) )
+#edges of the MT windows of the regions, and the MT flags passed in each
+#window (bisect_right/np.digitize index), as HiMT, LoMT, ... below
+mt_edges = [20, 40, 70, 120]
+mt_window_flags = [
+    ['LoMT', 'MTLt40'],             # MT < 20
+    ['HiMT', 'MTLt40'],             # 20 <= MT < 40
+    ['HiMT'],                       # 40 <= MT < 70
+    ['HiMT', 'VHiMT', 'MT70_120'],  # 70 <= MT < 120
+    ['HiMT', 'VHiMT'],              # MT >= 120
+]
+
+#tau IDs, in booking order, with the discriminators each one requires (on top of tDecayFinding).
+#Adding an ID only takes a line here
+tau_id_branches = [
+    ('VLooseIso',                      ['tVLooseIso']),
+    ('LooseIso',                       ['tLooseIso']),
+    ('MediumIso',                      ['tMediumIso']),
+    ('TightIso',                       ['tTightIso']),
+    ('LooseIso3Hits',                  ['tLooseIso3Hits']),
+    ('LooseIso3HitsAntiEleLoose',      ['tLooseIso3Hits', 'tAntiElectronLoose']),
+    ('LooseIso3HitsAntiEleMVAVLoose',  ['tLooseIso3Hits', 'tAntiElectronMVA5VLoose']),
+    ('LooseIso3HitsAntiEleMVALoose',   ['tLooseIso3Hits', 'tAntiElectronMVA5Loose']),
+    ('LooseIso3HitsAntiEleMVAMedium',  ['tLooseIso3Hits', 'tAntiElectronMVA5Medium']),
+    ('LooseIso3HitsAntiEleMVATight',   ['tLooseIso3Hits', 'tAntiElectronMVA5Tight']),
+    ('LooseIso3HitsAntiMuon3Tight',    ['tLooseIso3Hits', 'tAntiMuon3Tight']),
+    ('LooseIso3HitsAntiMuonMVATight',  ['tLooseIso3Hits', 'tAntiMuonMVATight']),
+    ('MediumIso3Hits',                 ['tMediumIso3Hits']),
+    ('TightIso3Hits',                  ['tTightIso3Hits']),
+    ('VLooseIsoMVA3OldDMNoLT',         ['tVLooseIsoMVA3OldDMNoLT']),
+    ('LooseIsoMVA3OldDMNoLT',          ['tLooseIsoMVA3OldDMNoLT']),
+    ('MediumIsoMVA3OldDMNoLT',         ['tMediumIsoMVA3OldDMNoLT']),
+    ('TightIsoMVA3OldDMNoLT',          ['tTightIsoMVA3OldDMNoLT']),
+    ('VTightIsoMVA3OldDMNoLT',         ['tVTightIsoMVA3OldDMNoLT']),
+    ('VVTightIsoMVA3OldDMNoLT',        ['tVVTightIsoMVA3OldDMNoLT']),
+    ('VLooseIsoMVA3OldDMLT',           ['tVLooseIsoMVA3OldDMLT']),
+    ('LooseIsoMVA3OldDMLT',            ['tLooseIsoMVA3OldDMLT']),
+    ('MediumIsoMVA3OldDMLT',           ['tMediumIsoMVA3OldDMLT']),
+    ('TightIsoMVA3OldDMLT',            ['tTightIsoMVA3OldDMLT']),
+    ('VTightIsoMVA3OldDMLT',           ['tVTightIsoMVA3OldDMLT']),
+    ('VVTightIsoMVA3OldDMLT',          ['tVVTightIsoMVA3OldDMLT']),
+]
 
 
 ################################################################################
@@ -47,7 +88,11 @@ class TauEffZMT(TauEffBase):
     tree = 'mt/final/Ntuple'
     def __init__(self, tree, outfile, **kwargs):
         super(TauEffZMT, self).__init__(tree, outfile,MuTauTree.MuTauTree, **kwargs)
-        self.pucorrector = mcCorrectors.make_puCorrector('singlemu')
+        self.load_corrections(mcCorrectors.get,
+            pucorrector                  = 'pu_singlemu',
+            pucorrector_array            = 'pu_singlemu_array',
+            muon_sf                      = 'muon_sf_id_iso_trigger', #PFTight x Iso x IsoMu24eta2p1
+            )
 
         #Not Used (yet)
         def make_iso_functor(name):
@@ -56,66 +101,41 @@ class TauEffZMT(TauEffBase):
                 return bool( getattr(row, attr) )
             return _f
 
-        self.objId = [
-            'VLooseIso' 	           ,
-            'LooseIso'  	           ,
-            'MediumIso' 	           ,
-            'TightIso'  	           ,
-            'LooseIso3Hits'                ,
-            'LooseIso3HitsAntiEleLoose'    ,
-            'LooseIso3HitsAntiEleMVAVLoose',
-            'LooseIso3HitsAntiEleMVALoose' ,
-            'LooseIso3HitsAntiEleMVAMedium',
-            'LooseIso3HitsAntiEleMVATight' ,
-            'LooseIso3HitsAntiMuon3Tight'  ,
-            'LooseIso3HitsAntiMuonMVATight',
-            'MediumIso3Hits' 	           ,
-            'TightIso3Hits'                ,
-            'VLooseIsoMVA3OldDMNoLT'       ,
-            'LooseIsoMVA3OldDMNoLT'        ,
-            'MediumIsoMVA3OldDMNoLT'       ,
-            'TightIsoMVA3OldDMNoLT'        ,
-            'VTightIsoMVA3OldDMNoLT'       ,
-            'VVTightIsoMVA3OldDMNoLT'      ,
-            'VLooseIsoMVA3OldDMLT'         ,
-            'LooseIsoMVA3OldDMLT'          ,
-            'MediumIsoMVA3OldDMLT'         ,
-            'TightIsoMVA3OldDMLT'          ,
-            'VTightIsoMVA3OldDMLT'         ,
-            'VVTightIsoMVA3OldDMLT'        ,
-            ]
+        self.objId = [name for name, _ in tau_id_branches]
 
         self.systematics  = ['NOSYS',"RAW"]+[i+j for i,j in itertools.product(['mes','tes','jes','ues'],['_p'])]#,'_m' add _m if needed also scaled down ['NOSYS']#['NOSYS']#
         self.id_functions = {
-            'VLooseIso' 	            : lambda row: bool(row.tDecayFinding) and bool(row.tVLooseIso),
-            'LooseIso'  	            : lambda row: bool(row.tDecayFinding) and bool(row.tLooseIso), 
-            'MediumIso' 	            : lambda row: bool(row.tDecayFinding) and bool(row.tMediumIso),
-            'TightIso'  	            : lambda row: bool(row.tDecayFinding) and bool(row.tTightIso), 
-            'LooseIso3Hits'                 : lambda row: bool(row.tDecayFinding) and bool(row.tLooseIso3Hits),	
-            'LooseIso3HitsAntiEleLoose'     : lambda row: bool(row.tDecayFinding) and bool(row.tLooseIso3Hits) and bool(row.tAntiElectronLoose),
-            'LooseIso3HitsAntiEleMVAVLoose' : lambda row: bool(row.tDecayFinding) and bool(row.tLooseIso3Hits) and bool(row.tAntiElectronMVA5VLoose),
-            'LooseIso3HitsAntiEleMVALoose'  : lambda row: bool(row.tDecayFinding) and bool(row.tLooseIso3Hits) and bool(row.tAntiElectronMVA5Loose), 
-            'LooseIso3HitsAntiEleMVAMedium' : lambda row: bool(row.tDecayFinding) and bool(row.tLooseIso3Hits) and bool(row.tAntiElectronMVA5Medium),
-            'LooseIso3HitsAntiEleMVATight'  : lambda row: bool(row.tDecayFinding) and bool(row.tLooseIso3Hits) and bool(row.tAntiElectronMVA5Tight), 
-            'LooseIso3HitsAntiMuon3Tight'   : lambda row: bool(row.tDecayFinding) and bool(row.tLooseIso3Hits) and bool(row.tAntiMuon3Tight),
-            'LooseIso3HitsAntiMuonMVATight' : lambda row: bool(row.tDecayFinding) and bool(row.tLooseIso3Hits) and bool(row.tAntiMuonMVATight),
-            'MediumIso3Hits' 	            : lambda row: bool(row.tDecayFinding) and bool(row.tMediumIso3Hits),
-            'TightIso3Hits'                 : lambda row: bool(row.tDecayFinding) and bool(row.tTightIso3Hits), 
-            'VLooseIsoMVA3OldDMNoLT'        : lambda row: bool(row.tDecayFinding) and bool(row.tVLooseIsoMVA3OldDMNoLT), 	
-            'LooseIsoMVA3OldDMNoLT'         : lambda row: bool(row.tDecayFinding) and bool(row.tLooseIsoMVA3OldDMNoLT),  	
-            'MediumIsoMVA3OldDMNoLT'        : lambda row: bool(row.tDecayFinding) and bool(row.tMediumIsoMVA3OldDMNoLT), 	
-            'TightIsoMVA3OldDMNoLT'         : lambda row: bool(row.tDecayFinding) and bool(row.tTightIsoMVA3OldDMNoLT),  	
-            'VTightIsoMVA3OldDMNoLT'        : lambda row: bool(row.tDecayFinding) and bool(row.tVTightIsoMVA3OldDMNoLT), 	
-            'VVTightIsoMVA3OldDMNoLT'       : lambda row: bool(row.tDecayFinding) and bool(row.tVVTightIsoMVA3OldDMNoLT),	
-            'VLooseIsoMVA3OldDMLT'          : lambda row: bool(row.tDecayFinding) and bool(row.tVLooseIsoMVA3OldDMLT), 
-            'LooseIsoMVA3OldDMLT'           : lambda row: bool(row.tDecayFinding) and bool(row.tLooseIsoMVA3OldDMLT),  
-            'MediumIsoMVA3OldDMLT'          : lambda row: bool(row.tDecayFinding) and bool(row.tMediumIsoMVA3OldDMLT), 
-            'TightIsoMVA3OldDMLT'           : lambda row: bool(row.tDecayFinding) and bool(row.tTightIsoMVA3OldDMLT),  
-            'VTightIsoMVA3OldDMLT'          : lambda row: bool(row.tDecayFinding) and bool(row.tVTightIsoMVA3OldDMLT), 
-            'VVTightIsoMVA3OldDMLT'         : lambda row: bool(row.tDecayFinding) and bool(row.tVVTightIsoMVA3OldDMLT),            'sign_cut'      : self.sign_cut,
+            'sign_cut'      : self.sign_cut,
             'muon_id'       : self.muon_id,
             'is_mu_anti_iso': self.is_mu_anti_iso,
             }
+        #preselection, the cuts are evaluated in order of rejection/cost
+        cuts = [ selections.Cut('isoMu24eta2p1 & match',
+                                lambda row: bool(row.isoMu24eta2p1Pass and row.mMatchesIsoMu24eta2p1),
+                                lambda chunk: (chunk['isoMu24eta2p1Pass'] != 0) & (chunk['mMatchesIsoMu24eta2p1'] != 0)) ]
+        cuts += selections.muSelection_cuts('m')
+        cuts += [ selections.Cut('mPt > 25', lambda row: row.mPt > 25, lambda chunk: chunk['mPt'] > 25),
+                  selections.Cut('mAbsEta < 2.1', lambda row: row.mAbsEta < 2.1, lambda chunk: chunk['mAbsEta'] < 2.1),
+                  selections.flag_cut('mPFIDTight') ]
+        cuts += selections.tauSelection_cuts('t')
+        cuts += [ selections.max_cut('tMuOverlap', 0) ]
+        cuts += selections.vetos_cuts()
+        cuts += [ selections.max_cut('m_t_Mass', 150) ]
+        #separate Z->tautau Z->mumu
+        if 'Zjets' in os.environ['megatarget']:
+            is_ztt = lambda row: bool(row.isGtautau or row.isZtautau)
+            is_ztt_array = lambda chunk: (chunk['isGtautau'] != 0) | (chunk['isZtautau'] != 0)
+            if 'ZToMuMu' in os.environ['megatarget']:
+                cuts.append( selections.Cut('!Z->tautau', lambda row: not is_ztt(row), lambda chunk: ~is_ztt_array(chunk)) )
+            else:
+                cuts.append( selections.Cut('Z->tautau', is_ztt, is_ztt_array) )
+        self.cutflow = selections.CutFlow(cuts, reorder=self.reorder_cuts)
+        #read only behind a short-circuit, the branch filter could miss them
+        self.extra_branches = ['mMatchesIsoMu24eta2p1', 'isGtautau', 'isZtautau', 'mRelPFIsoDBDefault']
+
+        #tau IDs, declared as the discriminators they need
+        self.id_table = IdTable(dict(tau_id_branches), common=['tDecayFinding'])
+        self.id_functions.update(self.id_table.functions())
         
         self.id_functions_with_sys = {
             'HiMT'     : self.HiMT    ,
@@ -125,10 +145,25 @@ class TauEffZMT(TauEffBase):
             'MTLt40'   : self.MTLt40  ,
             }
 
+        #array versions for the columnar engine
+        self.id_functions_array = {
+            'sign_cut'      : lambda chunk: chunk['m_t_SS'] == 0,
+            'muon_id'       : lambda chunk: selections.mu_idIso_array(chunk, 'm'),
+            'is_mu_anti_iso': lambda chunk: (chunk['mRelPFIsoDBDefault'] > 0.2) & (chunk['mRelPFIsoDBDefault'] < 0.5),
+            }
+
+        self.id_functions_with_sys_array = {
+            'HiMT'     : lambda chunk, sys: chunk[mt_branch[sys]] >= 20,
+            'LoMT'     : lambda chunk, sys: chunk[mt_branch[sys]] <  20,
+            'VHiMT'    : lambda chunk, sys: chunk[mt_branch[sys]] >= 70,
+            'MT70_120' : lambda chunk, sys: (chunk[mt_branch[sys]] >= 70) & (chunk[mt_branch[sys]] < 120),
+            'MTLt40'   : lambda chunk, sys: chunk[mt_branch[sys]] <  40,
+            }
+
 
     def build_folder_structure(self):
         flag_map = {}
-        systematics = self.systematics if not os.environ['megatarget'].startswith('data_') else self.systematics[0] #for data no shifting sys applied, save time!
+        #self.systematics is reduced at begin() to what the target needs (for data no shifting sys applied, save time!)
         for systematic in self.systematics:
             for obj_id_name in self.objId + ['QCD']:
                 for sign in ['ss', 'os']:
@@ -179,9 +214,44 @@ class TauEffZMT(TauEffBase):
 
         return weight *\
             self.pucorrector(row.nTruePU) * \
-            mcCorrectors.muon_pog_PFTight(row.mPt, row.mEta) * \
-            mcCorrectors.muon_pog_Iso(row.mPt, row.mEta) * \
-            mcCorrectors.muon_pog_IsoMu24eta2p1(row.mPt, row.mEta)
+            self.muon_sf(row.mPt, row.mEta)
+
+    def event_weight_array(self, chunk):
+        ''' Same as event_weight, on a chunk of events '''
+        is_data = chunk['run'] > 2
+        if is_data.all():
+            return 1.
+        weight = chunk['tauSpinnerWeight'] if 'TauSpinned' in os.environ['megatarget'] else 1.
+        weight = weight *\
+            self.pucorrector_array(chunk['nTruePU']) * \
+            self.muon_sf.array(chunk['mPt'], chunk['mEta'])
+        return np.where(is_data, 1., weight)
+
+    def compile_sys_words(self, flag_bits):
+        '''All the systematic dependent flags are MT windows: the MT of every
+        shift is read once (events x systematics matrix for a chunk) and
+        the window index gives, through a table, the word of all the flags'''
+        if not set(flag_bits) <= set(name for flags in mt_window_flags for name in flags):
+            return super(TauEffZMT, self).compile_sys_words(flag_bits)
+        branches   = [ mt_branch[systematic] for systematic in self.systematics ]
+        table      = [ sum(flag_bits[name] for name in flags if name in flag_bits) for flags in mt_window_flags ]
+        table.append(0) #NaN, fails every comparison
+        nan_window = len(table) - 1
+        table_array = np.array(table, dtype=np.int64)
+        get        = operator.attrgetter(*branches)
+        get_all    = get if len(branches) > 1 else lambda row: (get(row),)
+
+        def row_words(row):
+            return tuple( table[bisect.bisect_right(mt_edges, mt)] if mt == mt else 0 for mt in get_all(row) )
+
+        def array_words(chunk):
+            matrix  = np.column_stack([ chunk[branch] for branch in branches ])
+            windows = np.digitize(matrix.ravel(), mt_edges).reshape(matrix.shape)
+            windows[np.isnan(matrix)] = nan_window
+            words   = table_array[windows]
+            return [ words[:, column] for column in xrange(len(branches)) ]
+
+        return self.timed('sys_id', 'mt_windows', row_words), self.timed('sys_id', 'mt_windows_array', array_words)
 
     def sign_cut(self, row):
         return not row.m_t_SS
@@ -219,19 +289,19 @@ class TauEffZMT(TauEffBase):
             raise KeyError("the current systematic, %s is not recognized" % currect_systematic)
 
     def LoMT(self, row, sys):
-        return getsysattr(row, 'mMtToPfMET', sys) < 20
+        return getattr(row, mt_branch[sys]) < 20
 
-    def HiMT(self, row, currect_systematic):
-        return getsysattr(row, 'mMtToPfMET', sys) >= 20
+    def HiMT(self, row, sys):
+        return getattr(row, mt_branch[sys]) >= 20
 
-    def VHiMT(self, row, currect_systematic):
-        return getsysattr(row, 'mMtToPfMET', sys) >= 70
+    def VHiMT(self, row, sys):
+        return getattr(row, mt_branch[sys]) >= 70
 
-    def MT70_120(self, row, currect_systematic):
-        return 70 <= getsysattr(row, 'mMtToPfMET', sys) < 120
+    def MT70_120(self, row, sys):
+        return 70 <= getattr(row, mt_branch[sys]) < 120
 
-    def MTLt40(self, row, currect_systematic):
-        return getsysattr(row, 'mMtToPfMET', sys) < 40
+    def MTLt40(self, row, sys):
+        return getattr(row, mt_branch[sys]) < 40
 
     def muon_id(self, row):
         return selections.mu_idIso(row, 'm') 
@@ -240,28 +310,15 @@ class TauEffZMT(TauEffBase):
         return row.mRelPFIsoDBDefault > 0.2 and row.mRelPFIsoDBDefault < 0.5
 
     def preselection(self, row):
-        ''' Preselection applied to events.
+        ''' Preselection applied to events (the cuts of self.cutflow).
 
         Excludes FR object IDs and sign cut.
         '''
-        if not (row.isoMu24eta2p1Pass and \
-                row.mMatchesIsoMu24eta2p1):          return False #if not row.mMatchesIsoMu24eta2p1:         return False #
-        if not selections.muSelection(row, 'm'):     return False
-        if not (row.mPt > 25 and row.mAbsEta < 2.1): return False
-        if not bool(row.mPFIDTight):                 return False
-        if not selections.tauSelection(row, 't'):    return False
-        if row.tMuOverlap > 0:                       return False
-        if not selections.vetos(row):                return False
-        if row.m_t_Mass > 150:                    return False
+        return self.cutflow(row)
 
-        #separate Z->tautau Z->mumu
-        if 'Zjets' in os.environ['megatarget']:
-            if 'ZToMuMu' in os.environ['megatarget']:
-                if row.isGtautau or row.isZtautau: return False
-            else:
-                if not (row.isGtautau or row.isZtautau):  return False
-                    
-        return True
+    def preselection_array(self, chunk):
+        ''' Same as preselection, on a chunk of events '''
+        return self.cutflow.array(chunk)
 
 
 
@@ -1,4 +1,8 @@
 from FinalStateAnalysis.PlotTools.decorators import memo
+import columnar
+import numpy as np
+import operator
+import time
 
 @memo
 def getVar(name, var):
@@ -30,6 +34,171 @@ def mu_idIso(row, name):
     return bool(getattr(row, getVar(name, 'PFIDTight'))) \
         and bool(getattr(row, getVar(name, 'RelPFIsoDBDefault')) < 0.12)
 
+################################################################################
+#### Array versions (act on a columnar.ColumnChunk), must match the above ######
+################################################################################
 
+def muSelection_array(chunk, name, pt_thr=20):
+    return ~(chunk[getVar(name,'Pt')] < pt_thr) & \
+        ~(chunk[getVar(name,'AbsEta')] > 2.1) & \
+        ~(abs(chunk[getVar(name,'DZ')]) > 0.2)
 
+def tauSelection_array(chunk, name):
+    return ~(chunk[getVar(name,'Pt')] < 20) & \
+        ~(chunk[getVar(name,'AbsEta')] > 2.3) & \
+        ~(abs(chunk[getVar(name,'DZ')]) > 0.2)
 
+def vetos_array(chunk):
+    return (chunk['muVetoPt5'] == 0) & \
+        (chunk['bjetCSVVeto'] == 0) & \
+        (chunk['tauVetoPt20Loose3HitsVtx'] == 0) & \
+        (chunk['eVetoCicTightIso'] == 0)
+
+def mu_idIso_array(chunk, name):
+    return (chunk[getVar(name, 'PFIDTight')] != 0) \
+        & (chunk[getVar(name, 'RelPFIsoDBDefault')] < 0.12)
+
+################################################################################
+#### Declarative preselection ##################################################
+################################################################################
+
+class Cut(object):
+    '''One preselection requirement: row predicate, array version
+    (chunk --> boolean mask, optional) and its runtime statistics'''
+    __slots__ = ('name', 'row', 'array', 'sample_rejected', 'time')
+    def __init__(self, name, row, array=None):
+        self.name     = name
+        self.row      = row
+        self.array    = array
+        self.sample_rejected = 0  #events failing it, out of the sampled ones (all the cuts evaluated)
+        self.time     = 0.        #time spent on the calibration events
+
+def min_cut(branch, value):
+    'passes unless branch < value'
+    get = operator.attrgetter(branch)
+    return Cut('%s >= %s' % (branch, value), lambda row: not get(row) < value, lambda chunk: ~(chunk[branch] < value))
+
+def max_cut(branch, value, absolute=False):
+    'passes unless (|)branch(|) > value'
+    get = operator.attrgetter(branch)
+    if absolute:
+        return Cut('|%s| <= %s' % (branch, value), lambda row: not abs(get(row)) > value, lambda chunk: ~(abs(chunk[branch]) > value))
+    return Cut('%s <= %s' % (branch, value), lambda row: not get(row) > value, lambda chunk: ~(chunk[branch] > value))
+
+def flag_cut(branch):
+    'passes if branch is set'
+    get = operator.attrgetter(branch)
+    return Cut(branch, lambda row: bool(get(row)), lambda chunk: chunk[branch] != 0)
+
+def veto_cut(branch):
+    'passes if branch is not set'
+    get = operator.attrgetter(branch)
+    return Cut('!'+branch, lambda row: not get(row), lambda chunk: chunk[branch] == 0)
+
+def muSelection_cuts(name, pt_thr=20):
+    'same as muSelection, one cut per requirement'
+    return [ min_cut(getVar(name,'Pt'), pt_thr), max_cut(getVar(name,'AbsEta'), 2.1), max_cut(getVar(name,'DZ'), 0.2, absolute=True) ]
+
+def tauSelection_cuts(name):
+    'same as tauSelection, one cut per requirement'
+    return [ min_cut(getVar(name,'Pt'), 20), max_cut(getVar(name,'AbsEta'), 2.3), max_cut(getVar(name,'DZ'), 0.2, absolute=True) ]
+
+def vetos_cuts():
+    'same as vetos, one cut per requirement'
+    return [ veto_cut(branch) for branch in ['muVetoPt5', 'bjetCSVVeto', 'tauVetoPt20Loose3HitsVtx', 'eVetoCicTightIso'] ]
+
+class CutFlow(object):
+    '''Ordered list of cuts, all required.
+
+    Row by row the cuts run in short-circuit. The first calibration events
+    go through all of them, timing each one, then (if reorder) the cuts
+    are sorted by cost over rejection: the cheapest, most rejecting ones
+    run first. The result does not depend on the order. The array version
+    evaluates all the cuts in the declared order, on all the events.
+
+    Which cut rejects an event first depends on the order, which changes
+    with the calibration (and from shard to shard): the table gives instead
+    the fraction of the sampled events, the ones all the cuts were
+    evaluated on, failing each cut'''
+    def __init__(self, cuts, calibration=1000, reorder=True):
+        self.cuts        = list(cuts) #declared order
+        self.order       = list(cuts) #evaluation order
+        self.calibration = calibration
+        self.reordering  = reorder
+        self.calibrated  = 0 #events timed, row by row
+        self.sampled     = 0 #events all the cuts were evaluated on
+        self.events      = 0
+        self.passed      = 0
+
+    def __call__(self, row):
+        self.events += 1
+        if self.calibrated < self.calibration:
+            return self.calibrate(row)
+        for cut in self.order:
+            if not cut.row(row):
+                return False
+        self.passed += 1
+        return True
+
+    def calibrate(self, row):
+        self.calibrated += 1
+        self.sampled    += 1
+        result = True
+        for cut in self.order:
+            start  = time.time()
+            passed = cut.row(row)
+            cut.time += time.time() - start
+            if not passed:
+                cut.sample_rejected += 1
+                result = False
+        if result:
+            self.passed += 1
+        if self.calibrated == self.calibration and self.reordering:
+            self.reorder()
+        return result
+
+    def reorder(self):
+        self.order.sort(key=lambda cut: cut.time/max(cut.sample_rejected, 0.5))
+
+    def array(self, chunk):
+        mask = np.ones(len(chunk), dtype=bool)
+        for cut in self.cuts:
+            passed = columnar.evaluate(chunk, cut.row, cut.array)
+            cut.sample_rejected += len(chunk) - np.count_nonzero(passed)
+            mask &= passed
+        self.events  += len(chunk)
+        self.sampled += len(chunk)
+        self.passed  += np.count_nonzero(mask)
+        return mask
+
+    def counters(self):
+        'the event counts and cut statistics, as a dict (JSON friendly)'
+        return {
+            'events'     : self.events,
+            'passed'     : self.passed,
+            'sampled'    : self.sampled,
+            'calibrated' : self.calibrated,
+            'cuts'       : [ [cut.name, cut.sample_rejected, cut.time] for cut in self.cuts ], #declared order
+            }
+
+    def add_counters(self, counters):
+        'adds the counters of another cut flow with the same cuts (e.g. of a worker process)'
+        self.events  += counters['events']
+        self.passed  += counters['passed']
+        self.sampled += counters['sampled']
+        self.calibrated += counters['calibrated']
+        for cut, (name, sample_rejected, time_spent) in zip(self.cuts, counters['cuts']):
+            if name != cut.name:
+                raise ValueError('cut flows with different cuts: %s, %s' % (cut.name, name))
+            cut.sample_rejected += sample_rejected
+            cut.time += time_spent
+
+    def table(self):
+        lines = ['preselection: %i events, %i passed. Rejection rate of each cut alone, on the %i sampled events '
+                 '(all the cuts evaluated), in evaluation order' % (self.events, self.passed, self.sampled),
+                 '%-40s %12s %9s %14s' % ('cut', 'failed', 'fraction', 'cost [us/evt]')]
+        for cut in self.order:
+            lines.append( '%-40s %12i %8.2f%% %14s' % (
+                cut.name, cut.sample_rejected, 100.*cut.sample_rejected/self.sampled if self.sampled else 0.,
+                '%.3f' % (1e6*cut.time/self.calibrated) if self.calibrated else '-') )
+        return '\n'.join(lines)
@@ -0,0 +1,246 @@
+#! /bin/env python
+'''
+
+Event throughput of TauEffZMT and TauEffZMM on synthetic ntuples.
+
+For each channel and configuration (engine, histogram backend, data/MC)
+the analyzer runs in its own process, with the stand-ins of standins.py
+for the CMSSW-only modules (MC corrections are flat), on a tree made by
+make_ntuples.py (cached in benchmarks/data). Measured: time spent
+importing, constructing, in begin(), processing (events/s) and in
+finish(), peak RSS and the stage times of the profiler (TAUEFF_PROFILE).
+
+The output histograms of all the configurations of a channel and sample
+are compared bin for bin (contents, errors, entries) with the ones of the
+first configuration (rows/root by default): engines and backends must give
+the same results. The benchmark fails if they do not.
+
+The results are stored in benchmarks/results/<commit>.json and compared
+with the most recent ones of another commit, to spot regressions.
+benchmarks/results is versioned: commit the results of the runs that are
+to be the reference (on the same machine), the ntuples and outputs are not.
+
+Usage: python benchmarks/bench_analyzers.py [options]
+
+'''
+
+import glob
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+benchmarks = os.path.dirname(os.path.abspath(__file__))
+repository = os.path.dirname(benchmarks)
+
+analyzers = {
+    'mt' : ('TauEffZMT', 'mt/final/Ntuple'),
+    'mm' : ('TauEffZMM', 'mm/final/Ntuple'),
+}
+
+def ntuple_path(channel, nevents, is_data):
+    return os.path.join(benchmarks, 'data', '%s_%s_%i.root' % (channel, 'data' if is_data else 'mc', nevents))
+
+def run_analyzer(channel, ntuple, is_data, engine, backend, profile):
+    '''runs in the benchmark process: returns the measurements'''
+    os.environ.update({
+        'jobid'               : 'bench8TeV',
+        'megatarget'          : 'data_SingleMu_bench' if is_data else 'Zjets_M50_bench',
+        'TAUEFF_ENGINE'       : engine,
+        'TAUEFF_HISTO_BACKEND': backend,
+        'TAUEFF_PROFILE'      : '1' if profile else '0',
+        })
+    timing = {}
+    start  = time.time()
+    sys.path.insert(0, repository)
+    sys.path.insert(0, benchmarks)
+    import standins
+    standins.install()
+    import ROOT
+    ROOT.gROOT.SetBatch(True)
+    name, tree_path = analyzers[channel]
+    module = __import__(name)
+    if not is_data:
+        standins.flat_corrections()
+    timing['import'] = time.time() - start
+
+    infile  = ROOT.TFile.Open(ntuple)
+    tree    = infile.Get(tree_path)
+    outpath = output_path(channel, 'data' if is_data else 'mc', engine, backend)
+    outfile = ROOT.TFile.Open(outpath, 'recreate')
+    steps   = [
+        ('init'   , lambda: getattr(module, name)(tree, outfile)),
+        ('begin'  , lambda: analyzer.begin()),
+        ('process', lambda: analyzer.process()),
+        ('finish' , lambda: analyzer.finish()),
+        ]
+    analyzer = None
+    for step, call in steps:
+        start  = time.time()
+        result = call()
+        timing[step] = time.time() - start
+        if step == 'init':
+            analyzer = result
+    outfile.Close()
+
+    nevents = tree.GetEntries()
+    ret = {
+        'events'            : nevents,
+        'events_per_second' : nevents/timing['process'] if timing['process'] else None,
+        'peak_rss_mb'       : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.,
+        'timing'            : timing,
+        }
+    profile_path = os.path.splitext(outpath)[0] + '.profile.json'
+    if profile and os.path.isfile(profile_path):
+        with open(profile_path) as stored:
+            ret['stages'] = dict( (stage, values['seconds']) for stage, values in json.load(stored).get('stage', {}).iteritems() )
+    return ret
+
+def output_path(channel, sample, engine, backend):
+    return os.path.join(benchmarks, 'output', '%s_%s_%s_%s.root' % (channel, sample, engine, backend))
+
+def compare_outputs(reference_path, path, tolerance=1e-6):
+    '''compares bin for bin the histograms of two output files, returns the
+    list of the differences (empty if the same). Contents and errors are
+    compared with a relative tolerance (float sums in a different order)'''
+    import ROOT
+    sys.path.insert(0, repository)
+    import histoMerge
+    def histograms(file_path):
+        tfile = ROOT.TFile.Open(file_path)
+        ret   = {}
+        for key, obj in histoMerge.walk(tfile):
+            if obj.InheritsFrom('TH1'):
+                obj.SetDirectory(0)
+                ret[key] = obj
+        tfile.Close()
+        return ret
+    def close(a, b):
+        return abs(a - b) <= tolerance*max(abs(a), abs(b), 1.)
+
+    reference   = histograms(reference_path)
+    other       = histograms(path)
+    differences = [ '%s missing' % key for key in sorted(set(reference) - set(other)) ]
+    differences.extend( '%s not expected' % key for key in sorted(set(other) - set(reference)) )
+    for key in sorted(set(reference) & set(other)):
+        ref, histo = reference[key], other[key]
+        if ref.GetNcells() != histo.GetNcells():
+            differences.append('%s: %i bins instead of %i' % (key, histo.GetNcells(), ref.GetNcells()))
+            continue
+        if ref.GetEntries() != histo.GetEntries():
+            differences.append('%s: %i entries instead of %i' % (key, histo.GetEntries(), ref.GetEntries()))
+        for cell in xrange(ref.GetNcells()):
+            if not close(ref.GetBinContent(cell), histo.GetBinContent(cell)) or \
+               not close(ref.GetBinError(cell), histo.GetBinError(cell)):
+                differences.append('%s: bin %i is %g +- %g instead of %g +- %g' % (
+                    key, cell, histo.GetBinContent(cell), histo.GetBinError(cell), ref.GetBinContent(cell), ref.GetBinError(cell)))
+                break
+    return differences
+
+def commit_id():
+    commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=repository).strip()
+    dirty  = subprocess.call(['git', 'diff', '--quiet', 'HEAD', '--'] + glob.glob(os.path.join(repository, '*.py')), cwd=repository)
+    return commit + ('-dirty' if dirty else '')
+
+def previous_results(commit):
+    'timing results of the most recent benchmark of another commit'
+    paths = [ path for path in glob.glob(os.path.join(benchmarks, 'results', '*.json'))
+              if os.path.basename(path) != '%s.json' % commit ]
+    if not paths:
+        return None, {}
+    path = max(paths, key=os.path.getmtime)
+    with open(path) as stored:
+        return os.path.basename(path)[:-5], json.load(stored)['timing']
+
+def report(results, reference_name, reference):
+    lines = ['%-32s %12s %10s %9s %9s %9s' % ('configuration', 'events/s', 'RSS (MB)', 'begin', 'process', 'finish')]
+    for key in sorted(results):
+        result = results[key]
+        line   = '%-32s %12.1f %10.1f %8.2fs %8.2fs %8.2fs' % (
+            key, result['events_per_second'] or 0, result['peak_rss_mb'],
+            result['timing']['begin'], result['timing']['process'], result['timing']['finish'])
+        old = reference.get(key)
+        if old and old['events_per_second'] and result['events_per_second']:
+            line += '   %+.1f%% events/s vs %s' % (100.*(result['events_per_second']/old['events_per_second'] - 1.), reference_name)
+        lines.append(line)
+        for stage, seconds in sorted(result.get('stages', {}).iteritems(), key=lambda item: -item[1]):
+            lines.append('    %-28s %8.3f s' % (stage, seconds))
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser(description=__doc__)
+    parser.add_option('--events'  , type=int, dest='events', default=20000)
+    parser.add_option('--channels', dest='channels', default='mt,mm')
+    parser.add_option('--engines' , dest='engines' , default='rows,columnar', help='columnar needs root_numpy')
+    parser.add_option('--backends', dest='backends', default='root,ndarray')
+    parser.add_option('--samples' , dest='samples' , default='data,mc')
+    parser.add_option('--no-profile', action='store_false', dest='profile', default=True, help='no stage times, no profiling overhead')
+    parser.add_option('--run', dest='run', default=None, help='(internal) runs channel:sample:engine:backend')
+    options, NOTUSED = parser.parse_args()
+
+    if options.run:
+        channel, sample, engine, backend = options.run.split(':')
+        is_data = sample == 'data'
+        result  = run_analyzer(channel, ntuple_path(channel, options.events, is_data), is_data, engine, backend, options.profile)
+        print 'BENCHMARK ' + json.dumps(result)
+        sys.exit(0)
+
+    for directory in ['data', 'output', 'results']:
+        if not os.path.isdir(os.path.join(benchmarks, directory)):
+            os.makedirs(os.path.join(benchmarks, directory))
+    sys.path.insert(0, benchmarks)
+    import make_ntuples
+
+    results     = {}
+    consistency = {}
+    for channel in options.channels.split(','):
+        for sample in options.samples.split(','):
+            ntuple = ntuple_path(channel, options.events, sample == 'data')
+            if not os.path.isfile(ntuple):
+                print 'generating %s' % ntuple
+                make_ntuples.make_ntuple(channel, options.events, ntuple, sample == 'data')
+            for engine in options.engines.split(','):
+                for backend in options.backends.split(','):
+                    key     = '/'.join([channel, sample, engine, backend])
+                    command = [sys.executable, os.path.abspath(__file__), '--events', str(options.events),
+                               '--run', ':'.join([channel, sample, engine, backend])]
+                    if not options.profile:
+                        command.append('--no-profile')
+                    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=os.path.join(benchmarks, 'output'))
+                    output  = process.communicate()[0]
+                    lines   = [line for line in output.splitlines() if line.startswith('BENCHMARK ')]
+                    if process.returncode or not lines:
+                        print '%s failed:\n%s' % (key, output[-2000:])
+                        continue
+                    results[key] = json.loads(lines[-1][len('BENCHMARK '):])
+                    print '%s: %.1f events/s' % (key, results[key]['events_per_second'] or 0)
+            # same histograms from all the configurations
+            done = [ (engine, backend) for engine in options.engines.split(',') for backend in options.backends.split(',')
+                     if '/'.join([channel, sample, engine, backend]) in results ]
+            for engine, backend in done[1:]:
+                key = '/'.join([channel, sample, engine, backend])
+                consistency[key] = {
+                    'reference'   : '/'.join([channel, sample] + list(done[0])),
+                    'differences' : compare_outputs(output_path(channel, sample, *done[0]), output_path(channel, sample, engine, backend)),
+                    }
+
+    commit = commit_id()
+    reference_name, reference = previous_results(commit)
+    with open(os.path.join(benchmarks, 'results', '%s.json' % commit), 'w') as stored:
+        json.dump({'timing' : results, 'consistency' : consistency}, stored, indent=2, sort_keys=True)
+    print
+    print report(results, reference_name, reference)
+    print
+    inconsistent = [key for key in sorted(consistency) if consistency[key]['differences']]
+    for key in sorted(consistency):
+        differences = consistency[key]['differences']
+        print '%-32s %s %s' % (key, 'DIFFERS from' if differences else 'identical to', consistency[key]['reference'])
+        for difference in differences[:10]:
+            print '    ' + difference
+        if len(differences) > 10:
+            print '    ... %i more' % (len(differences) - 10)
+    if inconsistent:
+        sys.exit(1)
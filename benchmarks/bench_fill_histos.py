@@ -0,0 +1,153 @@
+#! /bin/env python
+'''
+
+Before/after benchmark of TauEffBase.fill_histos on a synthetic tree.
+
+Books the TauEffZMT histogram set (plus a TH2) in [nfolders] folders and fills all of
+them for each of the [nevents] events of a synthetic mt/final/Ntuple tree
+(make_ntuples.py, cached in benchmarks/data), read entry by entry as the
+analyzer does, once with the legacy loop (string splitting, InheritsFrom
+and hfunc checks per histogram) and once with the fill plans compiled by
+fillPlans. The time spent reading the tree alone is measured too and
+subtracted. Checks that the two give the same histograms and prints the
+timings.
+
+Usage: python benchmarks/bench_fill_histos.py [nevents] [nfolders]
+
+'''
+
+import itertools
+import os
+import sys
+import time
+import numpy as np
+import ROOT
+benchmarks = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(benchmarks))
+sys.path.insert(0, benchmarks)
+from fillPlans import compile_fill_plans
+import make_ntuples
+from standins import TreeWrapper
+
+ROOT.gROOT.SetBatch(True)
+ROOT.TH1.AddDirectory(False)
+
+#name, nbins, xmin, xmax as in TauEffZMT.book_histos
+histo_set = [
+    ("weight", 100, 0, 5),
+    ("rho", 100, 0, 25),
+    ("nvtx", 31, -0.5, 30.5),
+    ("mPt", 100, 0, 100),
+    ("tPt", 100, 0, 100),
+    ("mAbsEta", 100, 0, 5),
+    ("mMtToPfMet_Ty1", 200, 0, 400),
+    ("tAbsEta", 100, 0, 5),
+    ("m_t_Mass", 150, 0, 150),
+    ('bjetVeto', 5, -0.5, 4.5),
+    ('bjetCSVVeto', 5, -0.5, 4.5),
+    ('muVetoPt5', 5, -0.5, 4.5),
+    ('tauVetoPt20Loose3HitsVtx', 5, -0.5, 4.5),
+    ('eVetoCicTightIso', 5, -0.5, 4.5),
+    ('mPt#tPt', 20, 0, 100, 20, 0, 100),
+]
+
+def synthetic_tree(nevents):
+    'returns the synthetic mt ntuple (file, tree), generated the first time'
+    path = os.path.join(benchmarks, 'data', 'mt_mc_%i.root' % nevents)
+    if not os.path.isfile(path):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        make_ntuples.make_ntuple('mt', nevents, path, is_data=False)
+    tfile = ROOT.TFile.Open(path)
+    return tfile, tfile.Get('mt/final/Ntuple')
+
+def book(nfolders):
+    histograms      = {}
+    histo_locations = {}
+    for ifolder in range(nfolders):
+        folder = 'NOSYS/ID%i/os/HiMT' % ifolder
+        for definition in histo_set:
+            name = definition[0]
+            kind = ROOT.TH2F if len(definition) > 4 else ROOT.TH1F
+            histograms[folder+'/'+name] = kind(folder+'/'+name, name, *definition[1:])
+        histo_locations[folder] = [i[0] for i in histo_set]
+    return histograms, histo_locations
+
+def legacy_fill_histos(histograms, histo_locations, hfunc, folder, row, weight):
+    'TauEffBase.fill_histos before the fill plans'
+    folder_str = folder
+    for attr in histo_locations[folder_str]:
+        value = histograms[folder_str+'/'+attr]
+        if value.InheritsFrom('TH2'):
+            if attr in hfunc:
+                result, out_weight = hfunc[attr](row, weight)
+                r1, r2 = result
+                if out_weight is None:
+                    value.Fill( r1, r2 )
+                else:
+                    value.Fill( r1, r2, out_weight )
+            else:
+                attr1, attr2 = tuple(attr.split('#'))
+                v1 = getattr(row,attr1)
+                v2 = getattr(row,attr2)
+                value.Fill( v1, v2, weight ) if weight is not None else value.Fill( v1, v2 )
+        else:
+            if attr in hfunc:
+                result, out_weight = hfunc[attr](row, weight)
+                if out_weight is None:
+                    value.Fill( result )
+                else:
+                    value.Fill( result, out_weight )
+            else:
+                value.Fill( getattr(row,attr), weight ) if weight is not None else value.Fill( getattr(row,attr) )
+
+def identical(histos1, histos2):
+    for key, histo in histos1.iteritems():
+        other = histos2[key]
+        for ibin in range(histo.GetSize()):
+            if histo.GetBinContent(ibin) != other.GetBinContent(ibin) or \
+               histo.GetBinError(ibin) != other.GetBinError(ibin):
+                return False
+    return True
+
+if __name__ == "__main__":
+    nevents  = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    nfolders = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    hfunc    = {
+        'nTruePU' : lambda row, weight: (row.nTruePU,None),
+        'weight'  : lambda row, weight: (weight,None) if weight is not None else (1.,None),
+        }
+    tfile, tree = synthetic_tree(nevents)
+    weights     = np.random.RandomState(12345).uniform(0.5, 1.5, tree.GetEntries()).tolist()
+    rows        = TreeWrapper(tree)
+
+    start = time.time()
+    for row, weight in itertools.izip(rows, weights):
+        pass
+    t_read = time.time() - start
+
+    before, locations = book(nfolders)
+    start = time.time()
+    for row, weight in itertools.izip(rows, weights):
+        for folder in locations:
+            legacy_fill_histos(before, locations, hfunc, folder, row, weight)
+    t_before = time.time() - start - t_read
+
+    after, locations = book(nfolders)
+    start = time.time()
+    plans = compile_fill_plans(after, locations, hfunc, {})
+    t_compile = time.time() - start
+    start = time.time()
+    for row, weight in itertools.izip(rows, weights):
+        for folder in locations:
+            for plan in plans[folder]:
+                plan.fill( *plan.getter(row, weight) )
+    t_after = time.time() - start - t_read
+    tfile.Close()
+
+    nfills = nevents*nfolders*len(histo_set)
+    print '%i events x %i folders x %i histograms, reading the tree: %.3f s (subtracted)' % (nevents, nfolders, len(histo_set), t_read)
+    print 'legacy fill_histos: %8.3f s (%6.2f us/fill)' % (t_before, 1e6*t_before/nfills)
+    print 'fill plans        : %8.3f s (%6.2f us/fill), compiled in %.3f s' % (t_after, 1e6*t_after/nfills, t_compile)
+    print 'speedup           : %8.2f' % (t_before/t_after)
+    print 'identical output  : %s' % identical(before, after)
@@ -0,0 +1,156 @@
+#! /bin/env python
+'''
+
+Synthetic mt/final/Ntuple and mm/final/Ntuple trees, with the branches
+read by TauEffZMT and TauEffZMM and roughly realistic distributions
+(Z peak, falling pt spectra, MT of Z->tautau and W+jets, ID efficiencies
+decreasing with the tightness of the working point).
+
+Usage: python benchmarks/make_ntuples.py channel nevents output.root [--mc]
+
+'''
+
+import array
+import numpy as np
+import ROOT
+
+def flag(rng, n, efficiency):
+    return (rng.uniform(size=n) < efficiency).astype(np.float64)
+
+def pt(rng, n, mean, threshold):
+    return threshold + rng.exponential(mean, n)
+
+def mt_values(rng, n):
+    'MT of a Z->tautau (low) and W+jets (Jacobian peak at ~70) mixture'
+    wjets = rng.uniform(size=n) < 0.3
+    return np.where(wjets, np.abs(rng.normal(70, 15, n)), rng.exponential(20, n))
+
+def event_branches(rng, n, is_data, columns):
+    columns['run']     = np.full(n, 200000 if is_data else 1, dtype=np.int32)
+    columns['lumi']    = rng.randint(1, 2000, n).astype(np.int32)
+    columns['evt']     = rng.randint(1, 2**30, n).astype(np.int64)
+    columns['nTruePU'] = rng.uniform(0, 50, n)
+    columns['nvtx']    = rng.poisson(15, n).astype(np.float64)
+    columns['rho']     = rng.exponential(8, n)
+    columns['isoMu24eta2p1Pass'] = flag(rng, n, 0.9)
+    for veto, rate in [('muVetoPt5', 0.05), ('bjetVeto', 0.1), ('bjetCSVVeto', 0.1), ('tauVetoPt20Loose3HitsVtx', 0.05), ('eVetoCicTightIso', 0.03)]:
+        columns[veto] = (rng.uniform(size=n) < rate).astype(np.float64)
+    columns['isGtautau'] = np.zeros(n)
+    columns['isZtautau'] = flag(rng, n, 0.5)
+    columns['tauSpinnerWeight'] = rng.uniform(0.5, 1.5, n)
+
+def muon_branches(rng, n, name, columns):
+    columns[name+'Pt']     = pt(rng, n, 20, 10)
+    columns[name+'Eta']    = rng.uniform(-2.4, 2.4, n)
+    columns[name+'AbsEta'] = np.abs(columns[name+'Eta'])
+    columns[name+'DZ']     = rng.normal(0, 0.1, n)
+    columns[name+'PFIDTight'] = flag(rng, n, 0.95)
+    columns[name+'RelPFIsoDBDefault'] = rng.exponential(0.15, n)
+    columns[name+'MatchesIsoMu24eta2p1'] = flag(rng, n, 0.85)
+
+tau_discriminators = [
+    #increasing tightness within each family
+    ['tVLooseIso', 'tLooseIso', 'tMediumIso', 'tTightIso'],
+    ['tLooseIso3Hits', 'tMediumIso3Hits', 'tTightIso3Hits'],
+    ['tVLooseIsoMVA3OldDMNoLT', 'tLooseIsoMVA3OldDMNoLT', 'tMediumIsoMVA3OldDMNoLT', 'tTightIsoMVA3OldDMNoLT', 'tVTightIsoMVA3OldDMNoLT', 'tVVTightIsoMVA3OldDMNoLT'],
+    ['tVLooseIsoMVA3OldDMLT', 'tLooseIsoMVA3OldDMLT', 'tMediumIsoMVA3OldDMLT', 'tTightIsoMVA3OldDMLT', 'tVTightIsoMVA3OldDMLT', 'tVVTightIsoMVA3OldDMLT'],
+    ['tAntiElectronLoose'],
+    ['tAntiElectronMVA5VLoose', 'tAntiElectronMVA5Loose', 'tAntiElectronMVA5Medium', 'tAntiElectronMVA5Tight'],
+    ['tAntiMuon3Tight'],
+    ['tAntiMuonMVATight'],
+]
+
+def tau_branches(rng, n, columns):
+    columns['tPt']     = pt(rng, n, 15, 15)
+    columns['tEta']    = rng.uniform(-2.5, 2.5, n)
+    columns['tAbsEta'] = np.abs(columns['tEta'])
+    columns['tDZ']     = rng.normal(0, 0.1, n)
+    columns['tMuOverlap']    = flag(rng, n, 0.05)
+    columns['tDecayFinding'] = flag(rng, n, 0.8)
+    for family in tau_discriminators:
+        #one score per family: a tighter working point passes a subset of the looser ones
+        score = rng.uniform(size=n)
+        for position, name in enumerate(family):
+            columns[name] = (score > 0.3 + 0.6*position/len(family)).astype(np.float64)
+
+def mt_channel(rng, n, is_data):
+    columns = {}
+    event_branches(rng, n, is_data, columns)
+    muon_branches(rng, n, 'm', columns)
+    tau_branches(rng, n, columns)
+    columns['m_t_Mass'] = np.abs(rng.normal(65, 20, n))
+    columns['m_t_SS']   = flag(rng, n, 0.2)
+    mt = mt_values(rng, n)
+    columns['mMtToPfMet_Ty1'] = mt
+    columns['mMtToMET']       = mt*rng.normal(1., 0.1, n)
+    for shift in ['mes', 'tes', 'jes', 'ues']:
+        columns['mMtToPfMet_'+shift] = mt*rng.normal(1., 0.03, n)
+    return columns
+
+def mm_channel(rng, n, is_data):
+    columns = {}
+    event_branches(rng, n, is_data, columns)
+    muon_branches(rng, n, 'm1', columns)
+    muon_branches(rng, n, 'm2', columns)
+    columns['m1_m2_Mass'] = rng.normal(91, 3, n)
+    columns['m1_m2_SS']   = flag(rng, n, 0.05)
+    met = rng.exponential(20, n)
+    phi = rng.uniform(-np.pi, np.pi, n)
+    columns['type1_pfMetEt']  = met
+    columns['type1_pfMetPhi'] = phi
+    columns['m1_m2_ToMETDPhi_Ty1'] = rng.uniform(0, np.pi, n)
+    columns['pfMetEt']  = met
+    columns['pfMetPhi'] = phi
+    mt = rng.exponential(15, n)
+    columns['m1MtToPfMET'] = mt
+    for shift in ['mes', 'tes', 'jes', 'ues', 'ees']:
+        columns['m1MtToPfMET_'+shift] = mt*rng.normal(1., 0.03, n)
+    for shift in ['mes', 'tes', 'jes', 'ues']:
+        columns['pfMetEt_'+shift]  = met*rng.normal(1., 0.03, n)
+        columns['pfMetPhi_'+shift] = phi
+    return columns
+
+channels = {
+    'mt' : mt_channel,
+    'mm' : mm_channel,
+}
+
+def write(columns, path, tree_path):
+    '''writes the columns as tree_path (dir/subdir/tree) in path, as the
+    FSA ntuples: floats, run and lumi as ints, evt as long'''
+    tfile     = ROOT.TFile.Open(path, 'recreate')
+    directory = tfile
+    for name in tree_path.split('/')[:-1]:
+        directory = directory.mkdir(name)
+    directory.cd()
+    tree    = ROOT.TTree(tree_path.split('/')[-1], tree_path.split('/')[-1])
+    buffers = []
+    for name in sorted(columns):
+        values = columns[name]
+        if name == 'evt':
+            buffer, leaf = array.array('l', [0]), 'L'
+        elif values.dtype.kind == 'i':
+            buffer, leaf = array.array('i', [0]), 'I'
+        else:
+            buffer, leaf = array.array('f', [0.]), 'F'
+        tree.Branch(name, buffer, '%s/%s' % (name, leaf))
+        buffers.append( (buffer, values) )
+    for entry in xrange(len(columns['run'])):
+        for buffer, values in buffers:
+            buffer[0] = values[entry]
+        tree.Fill()
+    tree.Write()
+    tfile.Close()
+
+def make_ntuple(channel, nevents, path, is_data=True, seed=12345):
+    rng = np.random.RandomState(seed)
+    write(channels[channel](rng, nevents, is_data), path, '%s/final/Ntuple' % channel)
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser(usage='%prog channel nevents output.root', description=__doc__)
+    parser.add_option('--mc', action='store_true', dest='mc', default=False, help='MC events (run 1), data otherwise')
+    options, args = parser.parse_args()
+    if len(args) != 3:
+        parser.error('channel, number of events and output are needed')
+    make_ntuple(args[0], int(args[1]), args[2], not options.mc)
@@ -0,0 +1,89 @@
+'''
+
+Benchmark-only stand-ins for what the analyzers import from the CMSSW
+environment: FinalStateAnalysis MegaBase and memo, and the cython tree
+wrappers MuTauTree/MuMuTree (replaced by a generic PyROOT one, slower than
+the cython ones). install() puts them in sys.modules, it must be called
+before importing the analyzers. Never used by the analysis itself.
+
+'''
+
+import imp
+import sys
+import numpy as np
+import ROOT
+
+class MegaBase(object):
+    'same booking and writing as FinalStateAnalysis.PlotTools.MegaBase'
+    def __init__(self, tree, outfile, **kwargs):
+        self.tree       = tree
+        self.outfile    = outfile
+        self.histograms = {}
+
+    def book(self, location, name, *args, **kwargs):
+        kind      = kwargs.get('type', ROOT.TH1F)
+        directory = self.outfile
+        for subdir in filter(None, location.split('/')):
+            directory = directory.GetDirectory(subdir) or directory.mkdir(subdir)
+        directory.cd()
+        self.histograms['/'.join([location, name])] = kind(name, *args)
+
+    def write_histos(self):
+        self.outfile.Write()
+
+def memo(fcn):
+    cache = {}
+    def _memoized(*args):
+        if args not in cache:
+            cache[args] = fcn(*args)
+        return cache[args]
+    return _memoized
+
+class TreeWrapper(object):
+    'row access to a TTree, as the cython wrappers provide'
+    def __init__(self, tree):
+        self.__dict__['tree'] = tree
+
+    def __iter__(self):
+        tree = self.tree
+        for entry in xrange(tree.GetEntries()):
+            tree.GetEntry(entry)
+            yield self
+
+    def load_entry(self, entry):
+        self.tree.GetEntry(entry)
+
+    def __getattr__(self, name):
+        return getattr(self.tree, name)
+
+class FlatCorrection(object):
+    '''MC correction equal to 1, scalar or array (array too), for MC
+    targets: the real ones come from FinalStateAnalysis'''
+    def __call__(self, *args):
+        return 1.
+
+    def array(self, *arrays):
+        return np.ones(len(arrays[0]))
+
+def module(name, **content):
+    ret = imp.new_module(name)
+    ret.__dict__.update(content)
+    sys.modules[name] = ret
+    return ret
+
+def install():
+    module('FinalStateAnalysis')
+    module('FinalStateAnalysis.PlotTools')
+    module('FinalStateAnalysis.PlotTools.MegaBase', MegaBase=MegaBase)
+    module('FinalStateAnalysis.PlotTools.decorators', memo=memo)
+    module('MuTauTree', MuTauTree=TreeWrapper)
+    module('MuMuTree' , MuMuTree=TreeWrapper)
+
+def flat_corrections():
+    'replaces the MC corrections with FlatCorrection, to be called after install()'
+    import mcCorrectors
+    for name in list(mcCorrectors.factories):
+        if name.endswith('_array'):
+            mcCorrectors.factories[name] = lambda: FlatCorrection().array
+        else:
+            mcCorrectors.factories[name] = FlatCorrection
@@ -0,0 +1,46 @@
+'''
+
+Finds the branches an analyzer reads, so that the others can be disabled
+(SetBranchStatus) and are never read nor decompressed.
+
+The row functions (preselection cuts, IDs for every systematic, event
+weight, histogram values) are called on the first events through a proxy
+recording the attributes they access. Functions do not short-circuit
+across each other (all the cuts are called, even after a failing one),
+but a branch read only in rare events within a function can be missed,
+e.g. b in (a or b) when a is true on all the traced events: such branches
+MUST be declared in the analyzer (extra_branches), as a disabled branch
+silently keeps a stale value. The filter is opt-in (TAUEFF_BRANCH_FILTER=1).
+
+'''
+
+class TracingRow(object):
+    '''Forwards to row, recording the names accessed'''
+    __slots__ = ('row', 'used')
+    def __init__(self, row, used):
+        self.row  = row
+        self.used = used
+
+    def __getattr__(self, name):
+        self.used.add(name)
+        return getattr(self.row, name)
+
+def trace_branches(rows, calls):
+    '''calls every function(row) in calls on each of rows, returns the set
+    of the names they accessed'''
+    used = set()
+    for row in rows:
+        tracer = TracingRow(row, used)
+        for call in calls:
+            call(tracer)
+    return used
+
+def existing_branches(tree, names):
+    'the names that are branches of tree (not methods of the wrapper)'
+    return sorted( name for name in names if tree.GetBranch(name) )
+
+def enable_only(tree, branches):
+    'disables all the branches of tree but the given ones'
+    tree.SetBranchStatus('*', 0)
+    for name in branches:
+        tree.SetBranchStatus(name, 1)
@@ -0,0 +1,138 @@
+'''
+
+Columnar access to the analysis ntuples.
+
+The input tree is read in blocks of entries as NumPy arrays (via root_numpy),
+so that selections and weights can be evaluated as masks over a whole block
+and histograms filled with one FillN call each.
+
+'''
+
+import numpy as np
+import os
+
+try:
+    import root_numpy
+except ImportError:
+    root_numpy = None
+
+def read_branch(tree, name, start, stop):
+    'reads entries [start, stop) of a branch, floating point is promoted to double as PyROOT does'
+    column = root_numpy.tree2array(tree, branches=[name], start=start, stop=stop)[name]
+    if column.dtype.kind == 'f' and column.dtype != np.float64:
+        #float comparisons MUST be done in double precision, as in the row by row loop
+        column = column.astype(np.float64)
+    return column
+
+class ColumnChunk(object):
+    '''Block of consecutive entries of a tree.
+
+    Branches are read on first access and cached, a selected sub-chunk
+    (select) takes its columns from the parent one.
+    '''
+    def __init__(self, tree, start, stop, parent=None, index=None):
+        self.tree    = tree
+        self.start   = start
+        self.stop    = stop
+        self.parent  = parent
+        self.index   = index
+        self.columns = {}
+
+    def __len__(self):
+        return len(self.index) if self.index is not None else self.stop - self.start
+
+    def __getitem__(self, name):
+        if name not in self.columns:
+            if self.parent is not None:
+                self.columns[name] = self.parent[name][self.index]
+            else:
+                self.columns[name] = read_branch(self.tree, name, self.start, self.stop)
+        return self.columns[name]
+
+    def select(self, mask):
+        'returns the sub-chunk of the entries passing mask'
+        return ColumnChunk(self.tree, self.start, self.stop, self, np.flatnonzero(mask))
+
+    def rows(self):
+        'row-like view of every entry, for functions without an array version'
+        return (ChunkRow(self, i) for i in xrange(len(self)))
+
+class ChunkRow(object):
+    '''Mimics the cython tree wrapper for a single entry of a chunk'''
+    __slots__ = ('chunk', 'index')
+    def __init__(self, chunk, index):
+        self.chunk = chunk
+        self.index = index
+
+    def __getattr__(self, name):
+        return self.chunk[name][self.index]
+
+def iter_chunks(tree, chunk_size, start=0, stop=None):
+    'yields ColumnChunks covering the entries [start, stop) of tree'
+    if root_numpy is None:
+        raise ImportError('the columnar engine needs root_numpy, which is not available')
+    stop = tree.GetEntries() if stop is None else min(stop, tree.GetEntries())
+    for first in xrange(start, stop, chunk_size):
+        yield ColumnChunk(tree, first, min(first + chunk_size, stop))
+
+def evaluate(chunk, row_fcn, array_fcn=None, args=(), dtype=bool):
+    '''evaluates a selection/weight over the chunk.
+
+    Uses the array version if available, otherwise calls the row function
+    entry by entry (slow, but gives the very same result)
+    '''
+    ret = np.empty(len(chunk), dtype=dtype)
+    if array_fcn is not None:
+        ret[...] = array_fcn(chunk, *args) #broadcasts constants (e.g. weight of data)
+    else:
+        ret[...] = [row_fcn(row, *args) for row in chunk.rows()]
+    return ret
+
+def as_double(values):
+    return np.ascontiguousarray(values, dtype=np.float64)
+
+def as_arrays(values, weights):
+    'converts values (array or (x, y) pair) and weights to double arrays'
+    values = tuple(as_double(i) for i in values) if isinstance(values, tuple) else as_double(values)
+    return values, as_double(weights)
+
+def take(values, mask):
+    'selects the masked entries of values (array or (x, y) pair)'
+    return tuple(i[mask] for i in values) if isinstance(values, tuple) else values[mask]
+
+def fill(histo, values, weights):
+    '''fills histo in one call, values is an array or a (x, y) pair for TH2.
+
+    FillN performs the same operations (in the same order) as calling Fill
+    for each entry, so the result is identical to the row by row filling
+    '''
+    nentries = len(weights)
+    if not nentries:
+        return
+    weights = as_double(weights)
+    if isinstance(values, tuple):
+        xvals, yvals = values
+        histo.FillN(nentries, as_double(xvals), as_double(yvals), weights)
+    else:
+        histo.FillN(nentries, as_double(values), weights)
+
+class SkimWriter(object):
+    '''Collects the given branches of the selected entries of each chunk
+    and writes them to path as a flat tree, with the original types'''
+    def __init__(self, path, tree, branches, treename):
+        self.path     = path
+        self.treename = treename
+        self.dtype    = [ (name, root_numpy.tree2array(tree, branches=[name], start=0, stop=1).dtype[name]) for name in branches ]
+        self.blocks   = []
+
+    def add(self, chunk):
+        block = np.empty(len(chunk), dtype=self.dtype)
+        for name, _ in self.dtype:
+            block[name] = chunk[name] #back to the stored precision, exact
+        self.blocks.append(block)
+
+    def close(self):
+        data = np.concatenate(self.blocks) if self.blocks else np.empty(0, dtype=self.dtype)
+        tmp_path = self.path + '.tmp.root'
+        root_numpy.array2root(data, tmp_path, treename=self.treename, mode='recreate')
+        os.rename(tmp_path, self.path)
@@ -0,0 +1,101 @@
+'''
+
+Pre-compiled histogram filling.
+
+begin() turns every folder into a list of FillPlans, one per histogram:
+the histogram, its dimension and how to get its values, either for a row
+(branch getter, hfunc or pair of branches for TH2) or for a chunk of events.
+Filling an event is then a tight loop, without string handling or type checks.
+Plans filling the same variable share a key, so that when an event lands in
+many folders each variable is computed only once and reused by all of them.
+
+'''
+
+import itertools
+import numpy as np
+import operator
+
+class FillPlan(object):
+    __slots__ = ('histo', 'ndim', 'key', 'fill', 'getter', 'array_getter')
+    def __init__(self, histo, ndim, key, getter, array_getter):
+        self.histo        = histo
+        self.ndim         = ndim
+        self.key          = key #same for all the histograms filled with the same values
+        self.fill         = histo.Fill #bound once
+        self.getter       = getter       #(row, weight) --> arguments of Fill
+        self.array_getter = array_getter #(chunk, weights) --> (values, weights)
+
+################################################################################
+#### Row getters: return the arguments of histo.Fill ###########################
+################################################################################
+
+def attr_getter(attr):
+    get = operator.attrgetter(attr)
+    def _args(row, weight):
+        return (get(row), weight) if weight is not None else (get(row),)
+    return _args
+
+def pair_getter(attr1, attr2):
+    get = operator.attrgetter(attr1, attr2)
+    def _args(row, weight):
+        return get(row) + (weight,) if weight is not None else get(row)
+    return _args
+
+def hfunc_getter(fcn, is2D):
+    def _args(row, weight):
+        result, out_weight = fcn(row, weight)
+        result = tuple(result) if is2D else (result,)
+        return result + (out_weight,) if out_weight is not None else result #saves you when filling NTuples!
+    return _args
+
+################################################################################
+#### Chunk getters: return (values, weights) for columnar.fill #################
+################################################################################
+
+def attr_array_getter(attr):
+    return lambda chunk, weights: (chunk[attr], weights)
+
+def pair_array_getter(attr1, attr2):
+    return lambda chunk, weights: ((chunk[attr1], chunk[attr2]), weights)
+
+def hfunc_array_getter(fcn, array_fcn, is2D):
+    '''uses the array version of the hfunc if available, otherwise
+    evaluates the row one event by event'''
+    def _values(chunk, weights):
+        if array_fcn is not None:
+            values, out_weights = array_fcn(chunk, weights)
+        else:
+            results     = [fcn(row, weight) for row, weight in itertools.izip(chunk.rows(), weights)]
+            values      = [value for value, _ in results]
+            values      = tuple(np.array(i) for i in zip(*values)) if is2D and values else values
+            out_weights = [(1. if weight is None else weight) for _, weight in results]
+        if out_weights is None:
+            out_weights = np.ones(len(chunk))
+        return values, out_weights
+    return _values
+
+def make_plan(histo, attr, hfunc, hfunc_array):
+    'resolves, once for all, how the histogram named attr is filled'
+    is2D = histo.InheritsFrom('TH2')
+    if attr in hfunc:
+        getter       = hfunc_getter(hfunc[attr], is2D)
+        array_getter = hfunc_array_getter(hfunc[attr], hfunc_array.get(attr), is2D)
+    elif is2D:
+        attr1, attr2 = tuple(attr.split('#'))
+        getter       = pair_getter(attr1, attr2)
+        array_getter = pair_array_getter(attr1, attr2)
+    else:
+        getter       = attr_getter(attr)
+        array_getter = attr_array_getter(attr)
+    return FillPlan(histo, 2 if is2D else 1, (attr, is2D), getter, array_getter)
+
+def folder_plans(histograms, folder, attrs, hfunc, hfunc_array):
+    'returns the [FillPlan] of the histograms attrs of folder'
+    return [ make_plan(histograms[folder+'/'+attr], attr, hfunc, hfunc_array) for attr in attrs ]
+
+def compile_fill_plans(histograms, histo_locations, hfunc, hfunc_array):
+    'returns {folder : [FillPlan]}'
+    return dict(
+        (folder, folder_plans(histograms, folder, attrs, hfunc, hfunc_array))
+        for folder, attrs in histo_locations.iteritems()
+        )
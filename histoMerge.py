@@ -0,0 +1,61 @@
+'''
+
+Write/sum sets of histograms ({path : histogram}, as MegaBase.histograms)
+to and from ROOT files, used to merge partial results (e.g. of several
+worker processes). TH1::Add sums the bin contents, sumw2 and statistics,
+so merging is exact.
+
+'''
+
+import os
+import ROOT
+
+def get_directory(tfile, path):
+    'returns the (sub)directory at path, creating the missing ones'
+    directory = tfile
+    for name in filter(None, path.split('/')):
+        subdir = directory.GetDirectory(name)
+        directory = subdir if subdir else directory.mkdir(name)
+    return directory
+
+def split_path(key):
+    charpos = key.rfind('/')
+    return key[ : max(charpos, 0)], key[ charpos + 1 :]
+
+def write_histograms(histograms, path):
+    '''writes histograms to a new file, atomically: the file appears
+    only once complete'''
+    tmp_path = path + '.tmp'
+    tfile = ROOT.TFile.Open(tmp_path, 'recreate')
+    for key, histo in histograms.iteritems():
+        location, name = split_path(key)
+        if hasattr(histo, 'as_root'): #ndarray backend
+            histo = histo.as_root()
+        get_directory(tfile, location).WriteTObject(histo, name)
+    tfile.Close()
+    os.rename(tmp_path, path)
+
+def walk(directory, path=''):
+    'yields (path, object) of all the non-directory objects stored in directory'
+    for key in directory.GetListOfKeys():
+        obj      = key.ReadObj()
+        obj_path = '/'.join(filter(None, [path, key.GetName()]))
+        if obj.InheritsFrom('TDirectory'):
+            for item in walk(obj, obj_path):
+                yield item
+        else:
+            yield obj_path, obj
+
+def add_histograms(histograms, path, materialize=None):
+    '''adds to histograms the ones stored in path. Histograms missing
+    in the set (lazily booked) are created calling materialize(folder)'''
+    tfile = ROOT.TFile.Open(path)
+    if not tfile or tfile.IsZombie():
+        raise IOError('could not open %s' % path)
+    for key, other in walk(tfile):
+        if key not in histograms and materialize is not None:
+            materialize( split_path(key)[0] )
+        if key not in histograms:
+            raise KeyError('%s, stored in %s, is not booked' % (key, path))
+        histograms[key].Add(other)
+    tfile.Close()
@@ -0,0 +1,225 @@
+'''
+
+Histogram booking helpers.
+
+book_histos(folder) issues the very same book() calls for every folder.
+BookingTemplate takes the histograms MegaBase.book made for one folder as
+prototypes and clones them into each of the others, which is much faster
+than booking thousands of histograms one by one.
+
+ArrayHistoStore is an alternative backend built on the same prototypes:
+the bins of a histogram for all the folders live in one NumPy array
+(folders x cells), filled with index arithmetic replicating what TH1::Fill
+does, and converted to ROOT histograms only at writing time.
+
+'''
+
+import array
+import bisect
+import numpy as np
+
+class BookingTemplate(object):
+    def __init__(self, booked):
+        '''the prototypes are empty, detached copies of the histograms booked
+        for one folder, booked is [(name, histogram)]'''
+        self.prototypes = []
+        for name, histo in booked:
+            proto = histo.Clone(name)
+            proto.SetDirectory(0) #not written
+            proto.Reset()
+            self.prototypes.append( (name, proto) )
+
+    def clone_into(self, directory, folder, histograms):
+        'books the prototypes in folder (stored in directory, 0 for none)'
+        for name, proto in self.prototypes:
+            histo = proto.Clone(name)
+            histo.SetDirectory(directory)
+            histograms[folder+'/'+name] = histo
+
+################################################################################
+#### NumPy backend: all the folders of a histogram in one array ################
+################################################################################
+
+class ArrayAxis(object):
+    '''Replicates TAxis::FindBin, bit by bit'''
+    def __init__(self, axis):
+        self.nbins = axis.GetNbins()
+        self.xmin  = axis.GetXmin()
+        self.xmax  = axis.GetXmax()
+        xbins      = axis.GetXbins()
+        self.edges = [xbins[i] for i in range(xbins.GetSize())] if xbins.GetSize() else None
+
+    def find_bin(self, x):
+        if x < self.xmin:
+            return 0
+        if not x < self.xmax: #NaN ends up in the overflow, as in ROOT
+            return self.nbins + 1
+        if self.edges is None:
+            return 1 + int(self.nbins*(x - self.xmin)/(self.xmax - self.xmin))
+        return bisect.bisect_right(self.edges, x)
+
+    def find_bins(self, x):
+        with np.errstate(invalid='ignore'):
+            if self.edges is None:
+                inside = 1 + np.floor(self.nbins*(x - self.xmin)/(self.xmax - self.xmin))
+            else:
+                inside = np.searchsorted(self.edges, x, side='right')
+            inside = np.where(x < self.xmax, inside, self.nbins + 1) #NaN too
+            return np.where(x < self.xmin, 0, inside).astype(np.intp)
+
+def sequential_sum(start, values):
+    'start + values[0] + values[1] + ..., summed in this order as TH1::Fill does'
+    return np.cumsum(np.concatenate(([start], values)))[-1] if len(values) else start
+
+class ArrayVariable(object):
+    '''One booked histogram across all the folders: bin contents (in the
+    precision of the prototype), sum of squared weights, fill statistics
+    and number of entries, one row per folder'''
+    def __init__(self, proto, nfolders):
+        self.proto   = proto
+        self.ndim    = 2 if proto.InheritsFrom('TH2') else 1
+        self.axes    = [ArrayAxis(proto.GetXaxis())] + ([ArrayAxis(proto.GetYaxis())] if self.ndim == 2 else [])
+        self.stride  = self.axes[0].nbins + 2 #cells per row of a TH2
+        self.dtype   = np.float32 if proto.InheritsFrom('TArrayF') else np.float64
+        self.cast    = self.dtype
+        ncells       = proto.GetSize()
+        self.sumw    = np.zeros((nfolders, ncells), dtype=self.dtype)
+        self.sumw2   = np.zeros((nfolders, ncells))
+        self.stats   = np.zeros((nfolders, 7 if self.ndim == 2 else 4))
+        self.entries = np.zeros(nfolders)
+        self.weighted= np.zeros(nfolders, dtype=bool) #TH1 enables Sumw2 at the first weight != 1
+
+    def nbytes(self):
+        return sum(i.nbytes for i in (self.sumw, self.sumw2, self.stats, self.entries, self.weighted))
+
+    def fill(self, row, args):
+        'same as Fill(*args) on the histogram of folder row'
+        if self.ndim == 1:
+            x    = args[0]
+            w    = args[1] if len(args) > 1 else 1.
+            xbin = self.axes[0].find_bin(x)
+            cell = xbin
+            inrange = 0 < xbin <= self.axes[0].nbins
+        else:
+            x, y = args[0], args[1]
+            w    = args[2] if len(args) > 2 else 1.
+            xbin = self.axes[0].find_bin(x)
+            ybin = self.axes[1].find_bin(y)
+            cell = xbin + self.stride*ybin
+            inrange = 0 < xbin <= self.axes[0].nbins and 0 < ybin <= self.axes[1].nbins
+        self.sumw[row, cell]  += self.cast(w)
+        self.sumw2[row, cell] += w*w
+        self.entries[row]     += 1
+        if w != 1.:
+            self.weighted[row] = True
+        if inrange:
+            stats = self.stats[row]
+            stats[0] += w
+            stats[1] += w*w
+            stats[2] += w*x
+            stats[3] += w*x*x
+            if self.ndim == 2:
+                stats[4] += w*y
+                stats[5] += w*y*y
+                stats[6] += w*x*y
+
+    def fill_n(self, row, values, weights):
+        'same as FillN on the histogram of folder row, values is a list of arrays (one per axis)'
+        bins   = [axis.find_bins(i) for axis, i in zip(self.axes, values)]
+        cells  = bins[0] if self.ndim == 1 else bins[0] + self.stride*bins[1]
+        inrange= np.logical_and.reduce([(i > 0) & (i <= axis.nbins) for axis, i in zip(self.axes, bins)])
+        np.add.at(self.sumw[row] , cells, weights.astype(self.dtype)) #unbuffered: same order as Fill
+        np.add.at(self.sumw2[row], cells, weights*weights)
+        self.entries[row] += len(weights)
+        if (weights != 1.).any():
+            self.weighted[row] = True
+        weights = weights[inrange]
+        x       = values[0][inrange]
+        stats   = self.stats[row]
+        stats[0] = sequential_sum(stats[0], weights)
+        stats[1] = sequential_sum(stats[1], weights*weights)
+        stats[2] = sequential_sum(stats[2], weights*x)
+        stats[3] = sequential_sum(stats[3], weights*x*x)
+        if self.ndim == 2:
+            y = values[1][inrange]
+            stats[4] = sequential_sum(stats[4], weights*y)
+            stats[5] = sequential_sum(stats[5], weights*y*y)
+            stats[6] = sequential_sum(stats[6], weights*x*y)
+
+    def add(self, row, histo):
+        'same as Add(histo) on the histogram of folder row'
+        ncells   = self.sumw.shape[1]
+        contents = np.array([histo.GetBinContent(i) for i in xrange(ncells)])
+        self.sumw[row] = (self.sumw[row] + contents).astype(self.dtype)
+        if histo.GetSumw2N():
+            sumw2 = histo.GetSumw2()
+            self.sumw2[row] += np.array([sumw2[i] for i in xrange(ncells)])
+            self.weighted[row] = True
+        else:
+            self.sumw2[row] += np.abs(contents)
+        stats = array.array('d', [0.]*7)
+        histo.GetStats(stats)
+        self.stats[row]   += stats[:self.stats.shape[1]]
+        self.entries[row] += histo.GetEntries()
+
+    def reset(self, row):
+        for store in (self.sumw, self.sumw2, self.stats, self.entries, self.weighted):
+            store[row] = 0
+
+    def as_root(self, row):
+        'returns the ROOT histogram of folder row, not attached to any directory'
+        histo = self.proto.Clone(self.proto.GetName())
+        histo.SetDirectory(0)
+        sumw  = self.sumw[row]
+        for cell in np.flatnonzero(sumw):
+            histo.SetBinContent(int(cell), float(sumw[cell]))
+        if self.weighted[row]:
+            histo.Sumw2()
+            sumw2 = histo.GetSumw2()
+            for cell in np.flatnonzero(self.sumw2[row]):
+                sumw2.SetAt(float(self.sumw2[row, cell]), int(cell))
+        histo.PutStats(array.array('d', self.stats[row]))
+        histo.SetEntries(self.entries[row])
+        return histo
+
+class ArrayHisto(object):
+    '''Stands for the ROOT histogram of one folder, providing what the
+    analysis uses (Fill, FillN, Add, Reset, InheritsFrom)'''
+    __slots__ = ('variable', 'row')
+    def __init__(self, variable, row):
+        self.variable = variable
+        self.row      = row
+
+    def InheritsFrom(self, name):
+        return self.variable.proto.InheritsFrom(name)
+
+    def Fill(self, *args):
+        self.variable.fill(self.row, args)
+
+    def FillN(self, nentries, *arrays):
+        self.variable.fill_n(self.row, arrays[:-1], arrays[-1])
+
+    def Add(self, histo):
+        self.variable.add(self.row, histo)
+
+    def Reset(self):
+        self.variable.reset(self.row)
+
+    def as_root(self):
+        return self.variable.as_root(self.row)
+
+class ArrayHistoStore(object):
+    '''Keeps the histograms of all the folders in contiguous NumPy arrays,
+    one per booked variable, instead of one ROOT object per folder. They
+    are converted to ROOT histograms only when written'''
+    def __init__(self, template, folders):
+        self.rows      = dict( (folder, row) for row, folder in enumerate(folders) )
+        self.variables = [ (name, ArrayVariable(proto, len(folders))) for name, proto in template.prototypes ]
+
+    def nbytes(self):
+        return sum(variable.nbytes() for _, variable in self.variables)
+
+    def book_into(self, folder, histograms):
+        row = self.rows[folder]
+        for name, variable in self.variables:
+            histograms[folder+'/'+name] = ArrayHisto(variable, row)
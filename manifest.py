@@ -0,0 +1,128 @@
+#! /bin/env python
+'''
+Content based bookkeeping of the analysis results.
+
+The manifest of results/<jobid>/<Analyzer>/<sample>.root, stored next to
+it as <sample>.manifest.json, records the hashes of what the result
+depends on: the input file list (inputs/<jobid>/<sample>.txt), the local
+modules the analyzer imports (syntax tree only, comments and formatting
+changes do not count), the inputs of the MC corrections and the analyzer
+options set in the environment (TAUEFF_*) that can change the result:
+booking (template, backend, lazy booking, placeholders), skim and
+partials. The ones only changing the speed (engine, workers, chunk size,
+branch filter, cut reordering, profiling, routing cache) or where the
+scratch files go (skim and partials directories) are left out.
+
+manifest.py analyzer.py sample [sample ...] rewrites the manifests whose
+content changed, leaving the others (and their time stamps) untouched:
+the Rakefile makes the results depend on their manifest, so that only the
+affected samples are processed again.
+'''
+
+import ast
+import glob
+import hashlib
+import json
+import modulefinder
+import os
+
+def file_hash(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as infile:
+        for block in iter(lambda: infile.read(1 << 20), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def source_hash(path):
+    'hash of the syntax tree of a python source'
+    with open(path) as infile:
+        return hashlib.md5(ast.dump(ast.parse(infile.read(), path))).hexdigest()
+
+def local_modules(analyzer):
+    '''{module : path} of the analyzer and of the modules of its directory
+    it imports, directly or not'''
+    directory = os.path.dirname(os.path.abspath(analyzer))
+    finder    = modulefinder.ModuleFinder(path=[directory])
+    finder.run_script(analyzer)
+    modules   = dict(
+        (name, module.__file__) for name, module in finder.modules.iteritems()
+        if name != '__main__' and module.__file__ and module.__file__.endswith('.py')
+        and os.path.dirname(os.path.abspath(module.__file__)) == directory
+        )
+    modules[os.path.basename(analyzer)[:-3]] = analyzer #__main__ for modulefinder
+    return modules
+
+# TAUEFF_ options not changing the result
+neutral_options = set([
+    'ENGINE', 'WORKERS', 'CHUNK_SIZE', 'BRANCH_FILTER', 'TRACE_EVENTS', 'REORDER_CUTS', #speed only
+    'PROFILE', 'ROUTE_CACHE_SIZE',
+    'SKIM_DIR', 'PARTIALS_DIR', #scratch files
+    ])
+
+def analyzer_options(environ=os.environ):
+    '{option : value} of the TAUEFF_ options set'
+    return dict( (name[len('TAUEFF_'):], value) for name, value in environ.iteritems()
+                 if name.startswith('TAUEFF_') and name[len('TAUEFF_'):] not in neutral_options )
+
+def correction_inputs(jobid):
+    'the files the MC corrections are built from (PU distributions)'
+    return sorted(glob.glob(os.path.join('inputs', jobid, '*pu.root')))
+
+def build_manifest(jobid, analyzer, sample, modules, corrections, options):
+    return {
+        'analyzer'    : os.path.basename(analyzer),
+        'sample'      : sample,
+        'inputs'      : file_hash(os.path.join('inputs', jobid, '%s.txt' % sample)),
+        'modules'     : modules,
+        'corrections' : corrections,
+        'options'     : options,
+        }
+
+def manifest_path(jobid, analyzer, sample):
+    return os.path.join('results', jobid, os.path.basename(analyzer)[:-3], '%s.manifest.json' % sample)
+
+def changes(old, new):
+    'what differs between two manifests'
+    ret = []
+    for key in ('inputs', 'modules', 'corrections', 'options'):
+        if isinstance(new[key], dict):
+            ret.extend( '%s %s' % (key, name) for name in sorted(set(old.get(key, {})) | set(new[key]))
+                        if old.get(key, {}).get(name) != new[key].get(name) )
+        elif old.get(key) != new[key]:
+            ret.append(key)
+    return ret
+
+def sync(jobid, analyzer, samples):
+    '''rewrites the manifests that changed, returns the samples whose
+    result is to be made again'''
+    modules     = dict( (name, source_hash(path)) for name, path in local_modules(analyzer).iteritems() )
+    corrections = dict( (path, file_hash(path)) for path in correction_inputs(jobid) )
+    options     = analyzer_options()
+    outdated    = []
+    for sample in samples:
+        path     = manifest_path(jobid, analyzer, sample)
+        manifest = build_manifest(jobid, analyzer, sample, modules, corrections, options)
+        old      = {}
+        if os.path.isfile(path):
+            with open(path) as infile:
+                old = json.load(infile)
+        changed = changes(old, manifest)
+        if not changed:
+            continue
+        print '%s: %s' % (path, 'new' if not old else 'changed ' + ', '.join(changed))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as outfile:
+            json.dump(manifest, outfile, indent=2, sort_keys=True)
+        os.rename(tmp_path, path)
+        outdated.append(sample)
+    return outdated
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser(usage='%prog analyzer.py sample [sample ...]', description=__doc__)
+    options, args = parser.parse_args()
+    if len(args) < 2:
+        parser.error('an analyzer and at least one sample are needed')
+    sync(os.environ['jobid'], args[0], args[1:])
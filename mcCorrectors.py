@@ -1,12 +1,13 @@
 import os
 import glob
-import FinalStateAnalysis.TagAndProbe.MuonPOGCorrections as MuonPOGCorrections
-import FinalStateAnalysis.TagAndProbe.H2TauCorrections as H2TauCorrections
-import FinalStateAnalysis.TagAndProbe.PileupWeight as PileupWeight
+import bisect
+import hashlib
+import itertools
+import time
+import numpy as np
 
 # Determine MC-DATA corrections
 is7TeV = bool('7TeV' in os.environ['jobid'])
-print "Is 7TeV:", is7TeV
 
 # Make PU corrector from expected data PU distribution
 # PU corrections .root files from pileupCalc.py
@@ -14,29 +15,280 @@ pu_distributions  = {
     'singlemu' : glob.glob(os.path.join( 'inputs', os.environ['jobid'], 'data_SingleMu*pu.root')),
     }
 mc_pu_tag                  = 'S6' if is7TeV else 'S10'
+# tabulated PU weights are cached here, keyed by the content of the PU files
+pu_cache_dir               = os.path.join( 'inputs', os.environ['jobid'], '.pu_cache')
+
+#####################
+#  Registry
+#####################
+# Corrections are built on first use only: get(name) calls the factory
+# registered under name and keeps the result
+factories   = {} #name --> function building the correction
+corrections = {} #name --> correction, the ones built so far
+build_times = {} #name --> seconds spent building it
+
+def register(name):
+    'decorator registering the factory of a correction'
+    def _register(factory):
+        factories[name] = factory
+        return factory
+    return _register
+
+def get(name):
+    'returns the correction name, built on first use'
+    if name not in corrections:
+        if name not in factories:
+            raise KeyError('correction %s not defined. Please check the spelling or add it to mcCorrectors.py' % name)
+        start = time.time()
+        corrections[name] = factories[name]()
+        build_times[name] = time.time() - start
+        print 'mcCorrectors: %s built in %.3f s (7TeV: %s)' % (name, build_times[name], is7TeV)
+    return corrections[name]
+
+def report():
+    return 'mcCorrectors: %i corrections built in %.3f s' % (len(build_times), sum(build_times.itervalues()))
 
 ####################
 #2012 Corrections
 ###################
-muon_pog_IsoMu24eta2p1_2012 = MuonPOGCorrections.make_muon_pog_IsoMu24eta2p1_2012() #trigger
-muon_pog_PFTight_2012       = MuonPOGCorrections.make_muon_pog_PFTight_2012()  #ID
-muon_pog_Iso_2012           = MuonPOGCorrections.make_muon_pog_PFRelIsoDB012_2012() #Iso
+@register('muon_pog_IsoMu24eta2p1') #trigger
+def make_muon_pog_IsoMu24eta2p1():
+    import FinalStateAnalysis.TagAndProbe.MuonPOGCorrections as MuonPOGCorrections
+    return MuonPOGCorrections.make_muon_pog_IsoMu24eta2p1_2012()
 
+@register('muon_pog_PFTight') #ID
+def make_muon_pog_PFTight():
+    import FinalStateAnalysis.TagAndProbe.MuonPOGCorrections as MuonPOGCorrections
+    return MuonPOGCorrections.make_muon_pog_PFTight_2012()
 
-muon_pog_IsoMu24eta2p1 = muon_pog_IsoMu24eta2p1_2012
-muon_pog_PFTight       = muon_pog_PFTight_2012      
-muon_pog_Iso           = muon_pog_Iso_2012          
+@register('muon_pog_Iso') #Iso
+def make_muon_pog_Iso():
+    import FinalStateAnalysis.TagAndProbe.MuonPOGCorrections as MuonPOGCorrections
+    return MuonPOGCorrections.make_muon_pog_PFRelIsoDB012_2012()
+
+#####################
+#  Array versions
+#####################
+def lookup_probes(edges):
+    'one point inside each interval defined by edges, under and overflow included'
+    return [edges[0] - 1.] + [(low + high)/2. for low, high in zip(edges[:-1], edges[1:])] + [edges[-1] + 1.]
+
+def verification_probes(edges):
+    'points at, just below and just above each edge, plus some inside each interval'
+    points = [edges[0] - 100., edges[-1] + 1000.]
+    for edge in edges:
+        points += [np.nextafter(edge, -np.inf), edge, np.nextafter(edge, np.inf)]
+    for low, high in zip(edges[:-1], edges[1:]):
+        points += [low + (high - low)/4., low + 3*(high - low)/4.]
+    return points
+
+def mirror(edges):
+    return sorted(set(edges) | set(-i for i in edges))
+
+def is_uniform(edges):
+    widths = np.diff(edges)
+    return len(widths) > 0 and np.allclose(widths, widths[0])
+
+#bin index conventions: [low, high) and (low, high] edges, or the TAxis::FindBin
+#formula for equal width bins, which may differ from both next to the edges
+def find_bins(edges, values, side):
+    'index (0 is the underflow) of the bins of values'
+    if side != 'root':
+        return np.searchsorted(edges, values, side=side)
+    nbins, xmin, xmax = len(edges) - 1, edges[0], edges[-1]
+    with np.errstate(invalid='ignore'):
+        inside = 1 + np.floor(nbins*(values - xmin)/(xmax - xmin))
+        inside = np.where(values < xmax, inside, nbins + 1)
+        return np.where(values < xmin, 0, inside).astype(np.intp)
+
+def find_bin(edges, value, side):
+    'same as find_bins, for a single value (edges is a list)'
+    if side == 'right':
+        return bisect.bisect_right(edges, value)
+    if side == 'left':
+        return bisect.bisect_left(edges, value)
+    if value < edges[0]:
+        return 0
+    if not value < edges[-1]:
+        return len(edges)
+    return 1 + int((len(edges) - 1)*(value - edges[0])/(edges[-1] - edges[0]))
+
+class BinnedLookup(object):
+    '''Array version of a binned correction f(x[, y]): the function is
+    evaluated once per bin of the declared edges (one list per argument)
+    and looked up with np.searchsorted.
+
+    The table is verified against the function at (and around) every edge,
+    trying the [low, high), (low, high] and (equal width bins) TAxis::FindBin
+    conventions and, for the
+    arguments declared symmetric (edges of |x|), both a lookup in |x| and
+    one in the mirrored signed edges. If nothing matches (the declared
+    edges are not the ones of the correction) f is evaluated once per
+    unique input value instead.'''
+    def __init__(self, fcn, edges, symmetric=None):
+        self.fcn   = fcn
+        self.axes  = None #[(edges, fold in |x|, searchsorted side)], None: per unique value evaluation
+        self.table = None
+        name       = getattr(fcn, '__name__', fcn)
+        symmetric  = symmetric or [False]*len(edges)
+        try:
+            layouts  = [ ([(sorted(i), True), (mirror(i), False)] if sym else [(sorted(i), False)])
+                         for i, sym in zip(edges, symmetric) ]
+            points   = list(itertools.product(*[verification_probes(mirror(i) if sym else sorted(i))
+                                                for i, sym in zip(edges, symmetric)]))
+            expected = np.array([fcn(*point) for point in points])
+            points   = [np.array(i) for i in zip(*points)]
+            for layout in itertools.product(*layouts):
+                probes = [lookup_probes(axis_edges) for axis_edges, _ in layout]
+                table  = np.array([fcn(*point) for point in itertools.product(*probes)])
+                table  = table.reshape([len(i) for i in probes])
+                conventions = [ ('right', 'left', 'root') if is_uniform(axis_edges) else ('right', 'left')
+                                for axis_edges, _ in layout ]
+                for sides in itertools.product(*conventions):
+                    axes = [ (np.array(axis_edges, dtype=np.float64), fold, side)
+                             for (axis_edges, fold), side in zip(layout, sides) ]
+                    if (self.lookup(points, axes, table) == expected).all():
+                        self.axes, self.table = axes, table
+                        return
+        except Exception, e:
+            print 'BinnedLookup: could not tabulate %s (%s)' % (name, e)
+        print 'WARNING: %s does not match the declared binning, evaluating it per unique value' % name
+
+    @staticmethod
+    def lookup(arrays, axes, table):
+        index = tuple( find_bins(edges, np.abs(values) if fold else values, side)
+                       for values, (edges, fold, side) in zip(arrays, axes) )
+        return table[index]
+
+    def evaluate_unique(self, arrays):
+        values, inverse = np.unique(np.rec.fromarrays(arrays), return_inverse=True)
+        results = np.array([self.fcn(*[float(i) for i in value]) for value in values], dtype=np.float64)
+        return results[inverse]
+
+    def __call__(self, *arrays):
+        arrays = [np.asarray(i, dtype=np.float64) for i in arrays]
+        if self.axes is None:
+            return self.evaluate_unique(arrays)
+        return self.lookup(arrays, self.axes, self.table)
+
+#binning of the 2012 muon POG corrections, in pt and |eta|
+muon_pog_pt_edges  = [10, 20, 25, 30, 35, 40, 50, 60, 90, 140, 300, 500]
+muon_pog_eta_edges = [0, 0.9, 1.2, 2.1, 2.4]
+
+def make_muon_pog_array(corrector):
+    'array version of a muon POG corrector f(pt, eta)'
+    return BinnedLookup(corrector, [muon_pog_pt_edges, muon_pog_eta_edges], symmetric=[False, True])
+
+for name in ['muon_pog_IsoMu24eta2p1', 'muon_pog_PFTight', 'muon_pog_Iso']:
+    register(name+'_array')( lambda name=name: make_muon_pog_array(get(name)) )
+
+class ScaleFactorMap(object):
+    '''Product of several muon POG corrections f(pt, eta), tabulated once
+    per (pt, eta) bin: one lookup per muon instead of one call per factor.
+    Callable per muon, or on arrays with array(pt, eta)'''
+    def __init__(self, *factors):
+        self.factors = factors
+        self.array   = make_muon_pog_array(self.product)
+        if self.array.axes is not None:
+            self.axes  = [ ([float(i) for i in edges], fold, side) for edges, fold, side in self.array.axes ]
+            self.table = self.array.table.tolist()
+
+    def product(self, pt, eta):
+        ret = 1.
+        for factor in self.factors:
+            ret *= factor(pt, eta)
+        return ret
+
+    def __call__(self, pt, eta):
+        if self.array.axes is None: #could not be tabulated
+            return self.product(pt, eta)
+        (pt_edges, pt_fold, pt_side), (eta_edges, eta_fold, eta_side) = self.axes
+        return self.table[ find_bin(pt_edges , abs(pt)  if pt_fold  else pt , pt_side ) ] \
+                         [ find_bin(eta_edges, abs(eta) if eta_fold else eta, eta_side) ]
+
+#single muon scale factors
+register('muon_sf_id_iso_trigger')( lambda: ScaleFactorMap(get('muon_pog_PFTight'), get('muon_pog_Iso'), get('muon_pog_IsoMu24eta2p1')) )
+register('muon_sf_id_iso')( lambda: ScaleFactorMap(get('muon_pog_PFTight'), get('muon_pog_Iso')) )
 
 #####################
 #  PU Corrections
 #####################
+class PileupTable(object):
+    '''PU weights tabulated per bin of nTruePU, callable as PileupWeight.
+    Stored to/loaded from a small .npz file, without touching ROOT'''
+    def __init__(self, edges, side, weights):
+        self.edges   = np.asarray(edges, dtype=np.float64)
+        self.side    = side
+        self.weights = np.asarray(weights, dtype=np.float64)
+        #python copies for the per event call
+        self.edge_list   = [float(i) for i in self.edges]
+        self.weight_list = [float(i) for i in self.weights]
+
+    def __call__(self, nTruePU):
+        return self.weight_list[find_bin(self.edge_list, nTruePU, self.side)]
+
+    def array(self, nTruePU):
+        return self.weights[find_bins(self.edges, np.asarray(nTruePU, dtype=np.float64), self.side)]
+
+    def save(self, path):
+        'writes atomically: concurrent jobs never read a partial file'
+        tmp_path = '%s.%i.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as tmp:
+            np.savez(tmp, edges=self.edges, side=np.array(self.side), weights=self.weights)
+        os.rename(tmp_path, path)
+
+    @staticmethod
+    def load(path):
+        stored = np.load(path)
+        return PileupTable(stored['edges'], str(stored['side']), stored['weights'])
+
+def pu_cache_path(dataset, kind, files):
+    'the cache is keyed by the MC tag and the content of the data PU files'
+    digest = hashlib.md5(kind)
+    for path in sorted(files):
+        with open(path, 'rb') as pu_file:
+            digest.update(pu_file.read())
+    return os.path.join(pu_cache_dir, '%s_%s_%s.npz' % (dataset, kind, digest.hexdigest()))
+
 def make_puCorrector(dataset, kind=None):
-    'makes PU reweighting according to the pu distribution of the reference data and the MC, MC distribution can be forced'
+    '''makes PU reweighting according to the pu distribution of the reference data and the MC, MC distribution can be forced.
+    The weights are tabulated and cached on disk, later jobs load the table instead of the ROOT files'''
     if not kind:
         kind = mc_pu_tag
-    if dataset in pu_distributions:
-        return PileupWeight.PileupWeight( 'S6' if is7TeV else 'S10', *(pu_distributions[dataset]))
-    else:
+    if dataset not in pu_distributions:
         raise KeyError('dataset not present. Please check the spelling or add it to mcCorrectors.py')
+    cache_path = pu_cache_path(dataset, kind, pu_distributions[dataset])
+    if os.path.isfile(cache_path):
+        return PileupTable.load(cache_path)
+    import FinalStateAnalysis.TagAndProbe.PileupWeight as PileupWeight
+    corrector = PileupWeight.PileupWeight( kind, *(pu_distributions[dataset]))
+    lookup    = BinnedLookup(corrector, [pu_edges(corrector)])
+    if lookup.axes is None: #could not be tabulated, nothing to cache
+        return corrector
+    (edges, _, side), = lookup.axes
+    table = PileupTable(edges, side, lookup.table)
+    if not os.path.isdir(pu_cache_dir):
+        try:
+            os.makedirs(pu_cache_dir)
+        except OSError: #made by a concurrent job
+            pass
+    table.save(cache_path)
+    return table
+
+def pu_edges(pucorrector):
+    'binning of the PU weights: the one of the data distribution, if reachable, otherwise 0.1 wide bins up to 60'
+    data = getattr(pucorrector, 'data', None)
+    if data is not None and hasattr(data, 'GetXaxis'):
+        axis = data.GetXaxis()
+        return [axis.GetBinLowEdge(i) for i in range(1, axis.GetNbins() + 2)]
+    return [0.1*i for i in range(601)]
 
+def make_puCorrector_array(pucorrector):
+    'array version of a corrector made by make_puCorrector'
+    if isinstance(pucorrector, PileupTable):
+        return pucorrector.array
+    return BinnedLookup(pucorrector, [pu_edges(pucorrector)])
 
+for dataset in pu_distributions:
+    register('pu_'+dataset)( lambda dataset=dataset: make_puCorrector(dataset) )
+    register('pu_'+dataset+'_array')( lambda dataset=dataset: make_puCorrector_array(get('pu_'+dataset)) )
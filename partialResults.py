@@ -0,0 +1,146 @@
+#! /bin/env python
+'''
+
+Partial results, one histogram file per group of input files.
+
+With TAUEFF_PARTIALS=1 the analyzer processes its input files in groups
+(TAUEFF_PARTIAL_FILES per group, default 1) and writes the histograms of
+each group to results/<jobid>/<Analyzer>/partials/<sample>/<key>.root,
+where the key hashes the paths and the UUIDs of the files (listed in
+<key>.json). Groups whose partial file exists are skipped, so a rerun
+after a crash only processes the missing files, then all the partials
+are summed into the output.
+
+mega splits the file list of a sample among several analyzer instances
+sharing the directory: each one only removes the partials of its own
+files (changed or grouped differently) and the ones of files no longer
+listed in inputs/<jobid>/<sample>.txt, never the ones of its siblings.
+The partials of an instance reading a skim are keyed on the skim parts:
+these are traced back to the input files recorded in the skim.
+
+partialResults.py Analyzer sample merges whatever partials exist into
+results/<jobid>/<Analyzer>/<sample>.root, without running the analyzer.
+
+'''
+
+import glob
+import hashlib
+import itertools
+import json
+import os
+import ROOT
+import histoMerge
+
+def file_uuid(path):
+    'UUID of a ROOT file, a new one is assigned every time the file is written'
+    tfile = ROOT.TFile.Open(path)
+    if not tfile or tfile.IsZombie():
+        raise IOError('could not open %s' % path)
+    uuid = tfile.GetUUID().AsString()
+    tfile.Close()
+    return uuid
+
+def partials_dir(jobid, analyzer, sample):
+    return os.path.join('results', jobid, analyzer, 'partials', sample)
+
+def sample_files(jobid, sample):
+    'all the input files of the sample, None if the list is not available'
+    path = os.path.join('inputs', jobid, '%s.txt' % sample)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as listing:
+        return [ line.strip() for line in listing if line.strip() ]
+
+class PartialResults(object):
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, key):
+        return os.path.join(self.directory, '%s.root' % key)
+
+    def record_path(self, key):
+        return os.path.join(self.directory, '%s.json' % key)
+
+    def done(self, key):
+        return os.path.isfile(self.path(key))
+
+    def groups(self, file_ranges, files_per_group):
+        '''file_ranges is [(path, start, stop)] of the input files, returns
+        [(key, start, stop, paths)] of the groups of consecutive files'''
+        ret = []
+        for first in xrange(0, len(file_ranges), files_per_group):
+            group = file_ranges[first : first + files_per_group]
+            key   = hashlib.md5( '\n'.join('%s %s' % (path, file_uuid(path)) for path, _, _ in group) ).hexdigest()
+            ret.append( (key, group[0][1], group[-1][2], [path for path, _, _ in group]) )
+        return ret
+
+    def record(self, key, paths):
+        'lists the input files of the partial key, written before the partial itself'
+        tmp_path = self.record_path(key) + '.tmp'
+        with open(tmp_path, 'w') as record:
+            json.dump(paths, record)
+        os.rename(tmp_path, self.record_path(key))
+
+    def files_of(self, key):
+        'the input files of the partial key, None if not recorded'
+        if not os.path.isfile(self.record_path(key)):
+            return None
+        with open(self.record_path(key)) as record:
+            return json.load(record)
+
+    def remove_stale(self, keys, own_files, all_files=None, origins={}):
+        '''removes the partials of own_files (the input files of this
+        instance) that are not in keys (files changed or grouped differently)
+        and the partials of files not in all_files (the whole sample, if
+        known). origins is {skim part : [input files it was made from]}: the
+        partials of skim parts are compared through their input files'''
+        keys      = set(keys)
+        own_files = set(os.path.normpath(i) for i in own_files)
+        all_files = set(os.path.normpath(i) for i in all_files) if all_files is not None else None
+        origins   = dict( (os.path.normpath(part), [os.path.normpath(i) for i in inputs]) for part, inputs in origins.iteritems() )
+        for path in glob.glob(os.path.join(self.directory, '*.root')):
+            key   = os.path.basename(path)[:-len('.root')]
+            files = self.files_of(key)
+            if key in keys or files is None:
+                continue
+            files = set( itertools.chain.from_iterable(origins.get(os.path.normpath(i), [os.path.normpath(i)]) for i in files) )
+            if files & own_files or (all_files is not None and not files <= all_files):
+                print 'partials: removing stale %s' % path
+                for stale in (path, self.record_path(key)):
+                    try:
+                        os.remove(stale)
+                    except OSError: #removed by a sibling instance at the same time
+                        pass
+
+    def prepare(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+def merge_files(paths, output):
+    'sums the histograms stored in paths and writes them to output'
+    histograms = {}
+    for path in paths:
+        tfile = ROOT.TFile.Open(path)
+        if not tfile or tfile.IsZombie():
+            raise IOError('could not open %s' % path)
+        for key, histo in histoMerge.walk(tfile):
+            if key in histograms:
+                histograms[key].Add(histo)
+            else:
+                histograms[key] = histo.Clone()
+                histograms[key].SetDirectory(0)
+        tfile.Close()
+    histoMerge.write_histograms(histograms, output)
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser(usage='%prog Analyzer sample', description=__doc__)
+    options, args = parser.parse_args()
+    if len(args) != 2:
+        parser.error('an analyzer and a sample are needed')
+    analyzer, sample = args
+    jobid  = os.environ['jobid']
+    paths  = sorted(glob.glob(os.path.join(partials_dir(jobid, analyzer, sample), '*.root')))
+    output = os.path.join('results', jobid, analyzer, '%s.root' % sample)
+    print 'merging %i partial results into %s' % (len(paths), output)
+    merge_files(paths, output)
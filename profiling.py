@@ -0,0 +1,73 @@
+'''
+
+Opt-in profiling of the event loop (TAUEFF_PROFILE=1).
+
+The engine wraps the functions it calls (stages, cuts, IDs) with timers
+accumulating calls and wall time per (category, name). The totals are
+printed at the end and stored as JSON next to the output file, together
+with the events processed per second, so that regressions (e.g. a new ID
+or histogram) show up run after run.
+
+'''
+
+import json
+import time
+
+class Profiler(object):
+    def __init__(self):
+        self.entries = {} #(category, name) --> [calls, seconds]
+        self.events  = 0
+        self.wall    = 0.
+
+    def entry(self, category, name):
+        return self.entries.setdefault( (category, name), [0, 0.] )
+
+    def wrap(self, category, name, fcn):
+        'returns fcn, timed'
+        entry = self.entry(category, name)
+        timer = time.time
+        def _timed(*args):
+            start  = timer()
+            result = fcn(*args)
+            entry[1] += timer() - start
+            entry[0] += 1
+            return result
+        return _timed
+
+    def as_dict(self):
+        ret = {
+            'events'            : self.events,
+            'seconds'           : self.wall,
+            'events_per_second' : self.events/self.wall if self.wall else None,
+            }
+        for (category, name), (calls, seconds) in self.entries.iteritems():
+            ret.setdefault(category, {})[name] = {'calls' : calls, 'seconds' : seconds}
+        return ret
+
+    def dump(self, path):
+        with open(path, 'w') as output:
+            json.dump(self.as_dict(), output, indent=2, sort_keys=True)
+
+    def merge(self, path):
+        'adds the calls and times stored in path (e.g. by a worker process)'
+        with open(path) as stored:
+            info = json.load(stored)
+        self.events += info.pop('events')
+        for key in ['seconds', 'events_per_second']:
+            info.pop(key)
+        for category, entries in info.iteritems():
+            for name, values in entries.iteritems():
+                entry = self.entry(category, name)
+                entry[0] += values['calls']
+                entry[1] += values['seconds']
+
+    def report(self):
+        lines = ['profile: %i events in %.2f s (%s events/s)' % (
+            self.events, self.wall, '%.1f' % (self.events/self.wall) if self.wall else '-')]
+        for category in sorted(set(category for category, _ in self.entries)):
+            lines.append('  %s:' % category)
+            entries = sorted( [(name, values) for (cat, name), values in self.entries.iteritems() if cat == category],
+                              key=lambda item: -item[1][1] )
+            for name, (calls, seconds) in entries:
+                lines.append('    %-40s %12i calls %10.3f s %10.3f us/call' % (name, calls, seconds, 1e6*seconds/calls if calls else 0.))
+        return '\n'.join(lines)
@@ -0,0 +1,221 @@
+'''
+
+Compiled lookup of the analysis regions.
+
+build_folder_structure gives, for each folder, the values the selection
+flags must have. Here every flag gets a bit, so that the flags of an event
+become a single integer (word) and every folder a (mask, value) pair: the
+event belongs to the folder if word & mask == value. Folders with the same
+mask are grouped, matching an event costs one dict lookup per distinct mask.
+On top of that, the folders matched by each (systematic, word) are kept in a
+bounded LRU cache, as most of the events share a handful of flag combinations.
+
+Only some flags depend on the systematic shift: route_event takes the word
+of the constant flags and one word of shift-dependent flags per systematic.
+A shift whose word equals the nominal one reuses the nominal routing,
+translated to the shifted folders.
+
+IdTable packs declaratively defined IDs (the branches each one requires)
+straight into the bits of the word.
+
+'''
+
+import collections
+import itertools
+import numpy as np
+import operator
+
+class RegionIndex(object):
+    def __init__(self, folder_map, systematics, cache_size=4096):
+        self.cache      = collections.OrderedDict()
+        self.cache_size = cache_size
+        self.hits       = 0
+        self.misses     = 0
+        self.systematics = list(systematics)
+        self.flags = sorted(set(name for selection in folder_map.itervalues() for name in selection))
+        self.bits  = dict( (name, 1 << position) for position, name in enumerate(self.flags) )
+        self.tables = {}
+        for systematic in systematics:
+            groups = {}
+            for folder, selection in sorted(folder_map.iteritems()):
+                if not folder.startswith(systematic): #Folder name starts with the systematic (if there are any)
+                    continue
+                mask, value = self.encode_selection(selection)
+                groups.setdefault(mask, {}).setdefault(value, []).append(folder)
+            self.tables[systematic] = [
+                (mask, dict( (value, tuple(folders)) for value, folders in values.iteritems() ))
+                for mask, values in sorted(groups.iteritems())
+                ]
+        # shift --> {nominal folder : shifted folder}, for the shifts with the same regions as the nominal
+        self.aligned = {}
+        nominal = self.systematics[0]
+        nominal_folders = [folder for folder in folder_map if folder.startswith(nominal)]
+        for shift in self.systematics[1:]:
+            mapping = dict( (folder, shift + folder[len(nominal):]) for folder in nominal_folders )
+            if all(folder_map.get(shifted) == folder_map[folder] for folder, shifted in mapping.iteritems()) and \
+               len(mapping) == len([folder for folder in folder_map if folder.startswith(shift)]):
+                self.aligned[shift] = mapping
+
+    def encode_selection(self, selection):
+        'converts a region selection into its (mask, value) pair'
+        mask, value = 0, 0
+        for name, info in selection.iteritems():
+            mask |= self.bits[name]
+            if info:
+                value |= self.bits[name]
+        return mask, value
+
+    def flags_in(self, functions, exclude=()):
+        '''returns [(name, bit)] of the functions whose flag is used by at
+        least one region, the others do not need to be evaluated'''
+        return [ (name, self.bits[name]) for name in self.flags if name in functions and name not in exclude ]
+
+    def match(self, systematic, word):
+        'returns the folders of systematic the event word belongs to'
+        folders = []
+        for mask, values in self.tables[systematic]:
+            matched = values.get(word & mask)
+            if matched:
+                folders.extend(matched)
+        return folders
+
+    def match_event(self, constant_word, sys_words):
+        'returns the folders of all the systematics an event belongs to'
+        nominal_word    = sys_words[0]
+        nominal_folders = self.match(self.systematics[0], constant_word | nominal_word)
+        folders         = list(nominal_folders)
+        for shift, word in zip(self.systematics[1:], sys_words[1:]):
+            if word == nominal_word and shift in self.aligned:
+                mapping = self.aligned[shift]
+                folders.extend( [mapping[folder] for folder in nominal_folders] )
+            else:
+                folders.extend( self.match(shift, constant_word | word) )
+        return folders
+
+    def route(self, systematic, word):
+        'memoized version of match'
+        return self.lookup( (systematic, word), self.match, systematic, word )
+
+    def route_event(self, constant_word, sys_words):
+        '''memoized version of match_event, sys_words is a tuple with the word
+        of the systematic dependent flags for each systematic'''
+        return self.lookup( (constant_word, sys_words), self.match_event, constant_word, sys_words )
+
+    def lookup(self, key, match, *args):
+        cache   = self.cache
+        folders = cache.pop(key, None) #popped and re-inserted to keep the LRU order
+        if folders is None:
+            self.misses += 1
+            folders = tuple(match(*args))
+            if len(cache) >= self.cache_size:
+                if not self.cache_size:
+                    return folders
+                cache.popitem(last=False)
+        else:
+            self.hits += 1
+        cache[key] = folders
+        return folders
+
+    def counters(self):
+        return {'hits' : self.hits, 'misses' : self.misses}
+
+    def add_counters(self, counters):
+        'adds the cache statistics of another index (e.g. of a worker process)'
+        self.hits   += counters['hits']
+        self.misses += counters['misses']
+
+    def report(self):
+        lookups = self.hits + self.misses
+        return 'region routing cache: %i hits, %i misses (%.1f%% hit rate), %i/%i entries used' % \
+            (self.hits, self.misses, 100.*self.hits/lookups if lookups else 0., len(self.cache), self.cache_size)
+
+    def encode_array(self, flag_arrays, nentries):
+        '''same as building the word event by event, for a chunk of events.
+        flag_arrays is [(bit, boolean array)]'''
+        if len(self.flags) > 63:
+            raise ValueError('too many selection flags (%i) to pack them in 64 bits' % len(self.flags))
+        words = np.zeros(nentries, dtype=np.int64)
+        for bit, flags in flag_arrays:
+            words[flags] |= bit
+        return words
+
+    def match_array(self, systematic, words):
+        '''returns {folder : boolean mask of the events belonging to it}.
+        Each distinct word of the chunk is matched only once'''
+        unique, inverse = np.unique(words, return_inverse=True)
+        positions = {}
+        for position, word in enumerate(unique):
+            for folder in self.route(systematic, int(word)):
+                positions.setdefault(folder, []).append(position)
+        return dict( (folder, np.in1d(inverse, matched)) for folder, matched in positions.iteritems() )
+
+class IdTable(object):
+    '''Object IDs defined by the boolean branches they require (plus the
+    common ones, required by all of them).
+
+    compile() gives the functions computing, for a row or a chunk, the
+    word with the region bits of the IDs passed: each distinct branch is
+    read once and packed in a bitmask, the IDs passed by each bitmask are
+    worked out once and cached'''
+    def __init__(self, definitions, common=()):
+        self.names    = sorted(definitions)
+        self.branches = sorted(set(common) | set(branch for branches in definitions.itervalues() for branch in branches))
+        self.bits     = dict( (branch, 1 << position) for position, branch in enumerate(self.branches) )
+        self.masks    = dict(
+            (name, sum(self.bits[branch] for branch in set(common) | set(branches)))
+            for name, branches in definitions.iteritems()
+            )
+
+    def functions(self):
+        'row by row predicates {name : function(row)}, for who needs them one by one'
+        def make_id(branches):
+            get = operator.attrgetter(*branches)
+            if len(branches) == 1:
+                return lambda row: bool(get(row))
+            return lambda row: all(get(row))
+        return dict(
+            (name, make_id([branch for branch in self.branches if self.bits[branch] & mask]))
+            for name, mask in self.masks.iteritems()
+            )
+
+    def compile(self, flag_bits):
+        '''flag_bits is {ID name : region bit}, the IDs not in there are
+        not computed. Returns (row_word, array_word) functions'''
+        targets = [ (self.masks[name], bit) for name, bit in sorted(flag_bits.iteritems()) ]
+        needed  = reduce(operator.or_, [mask for mask, _ in targets], 0)
+        reads   = [ (self.bits[branch], branch) for branch in self.branches if self.bits[branch] & needed ]
+        read_bits = [ bit for bit, _ in reads ]
+        getter  = operator.attrgetter(*[branch for _, branch in reads]) if reads else None
+        cache   = {}
+
+        def word_of(passed):
+            word = cache.get(passed)
+            if word is None:
+                word = 0
+                for mask, bit in targets:
+                    if passed & mask == mask:
+                        word |= bit
+                cache[passed] = word
+            return word
+
+        def row_word(row):
+            if getter is None:
+                return word_of(0)
+            values = getter(row)
+            if len(reads) == 1:
+                values = (values,)
+            passed = 0
+            for bit, value in itertools.izip(read_bits, values):
+                if value:
+                    passed |= bit
+            return word_of(passed)
+
+        def array_word(chunk):
+            passed = np.zeros(len(chunk), dtype=np.int64)
+            for bit, branch in reads:
+                passed[chunk[branch] != 0] |= bit
+            unique, inverse = np.unique(passed, return_inverse=True)
+            words = np.array([word_of(int(i)) for i in unique], dtype=np.int64)
+            return words[inverse]
+
+        return row_word, array_word
@@ -7,5 +7,5 @@ set -o errexit
 source jobid.sh
 
 export jobid=$jobid8
-rake mm
-rake mt
+# mm and mt samples run concurrently, longest first (see schedule_jobs.py --help)
+python schedule_jobs.py mm mt
@@ -0,0 +1,200 @@
+#! /bin/env python
+'''
+Runs the sample jobs of rake tasks (e.g. mm and mt) concurrently.
+
+The result files the tasks depend on are taken from the rake task listing
+(rake -P) and made one by one with rake (so the manifests decide what is
+to be processed again), up to --jobs at the same time. The longest jobs,
+according to the runtimes recorded by the previous runs, start first;
+jobs never run before are considered the longest. Each job has its
+output in <result>.log.
+
+--max-rss is a memory budget per job: the resident memory (RSS) summed
+over all the processes of the job (rake, the analyzer and its workers),
+read from /proc. A job above it is killed, with all its processes, and
+its partial result removed. The virtual address space is not limited,
+ROOT reserves much more of it than it uses.
+
+At the end the makespan, the duration and peak RSS of each job are printed.
+'''
+
+import json
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import time
+
+def task_results(tasks):
+    '{task : [result files it depends on]}, parsed from rake -P'
+    listing = subprocess.check_output(['rake', '-P'])
+    ret     = {}
+    current = None
+    for line in listing.splitlines():
+        if line.startswith('rake '):
+            current = line.split()[1]
+        elif current in tasks and line.strip().endswith('.root'):
+            ret.setdefault(current, []).append(line.strip())
+    return ret
+
+def load_runtimes(path):
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as infile:
+        return json.load(infile)
+
+def save_runtimes(runtimes, path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as outfile:
+        json.dump(runtimes, outfile, indent=2, sort_keys=True)
+    os.rename(tmp_path, path)
+
+page_size = os.sysconf('SC_PAGE_SIZE')
+
+def child_pids():
+    '{pid : [children pids]} of all the running processes'
+    ret = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % name) as stat:
+                ppid = int(stat.read().rsplit(')', 1)[1].split()[1])
+        except (IOError, OSError, IndexError): #gone meanwhile
+            continue
+        ret.setdefault(ppid, []).append(int(name))
+    return ret
+
+def tree_rss(pid, children):
+    'resident memory (bytes) of pid and of all its descendants'
+    total   = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        pending.extend(children.get(current, []))
+        try:
+            with open('/proc/%i/statm' % current) as statm:
+                total += int(statm.read().split()[1])*page_size
+        except (IOError, OSError):
+            continue
+    return total
+
+def mtime(path):
+    return os.path.getmtime(path) if os.path.isfile(path) else None
+
+class Job(object):
+    def __init__(self, target):
+        self.target  = target
+        self.process = None
+        self.start   = None
+        self.stop    = None
+        self.before  = mtime(target)
+        self.peak_rss = 0
+        self.killed   = False
+
+    def launch(self):
+        logfile      = open(self.target.replace('.root', '.log'), 'w')
+        self.start   = time.time()
+        # own process group, to kill the whole job
+        self.process = subprocess.Popen(['rake', self.target], stdout=logfile, stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+        logfile.close()
+
+    def check_memory(self, children, max_rss):
+        'records the RSS of the job, kills it if above max_rss (bytes)'
+        rss = tree_rss(self.process.pid, children)
+        self.peak_rss = max(self.peak_rss, rss)
+        if max_rss is not None and rss > max_rss and not self.killed:
+            self.killed = True
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except OSError: #already gone
+                pass
+
+    def poll(self):
+        if self.process.poll() is None:
+            return False
+        self.stop = time.time()
+        if self.killed and mtime(self.target) != self.before and os.path.isfile(self.target):
+            os.remove(self.target) #incomplete, it would look up to date
+        return True
+
+    def duration(self):
+        return self.stop - self.start
+
+    def ran(self):
+        'if the result was made again (and not up to date already)'
+        return self.process.returncode == 0 and mtime(self.target) != self.before
+
+def schedule(targets, runtimes, njobs, max_rss=None):
+    '''runs the targets, longest first, returns the Jobs. Jobs using more
+    than max_rss bytes of resident memory are killed'''
+    pending = sorted(targets, key=lambda target: runtimes.get(target, float('inf')), reverse=True)
+    running = []
+    done    = []
+    while pending or running:
+        while pending and len(running) < njobs:
+            job = Job(pending.pop(0))
+            job.launch()
+            print 'started %s (expected %s)' % (job.target, '%.0f s' % runtimes[job.target] if job.target in runtimes else 'unknown')
+            running.append(job)
+        children = child_pids()
+        for job in running:
+            job.check_memory(children, max_rss)
+        for job in [i for i in running if i.poll()]:
+            running.remove(job)
+            done.append(job)
+            print '%s %s in %.0f s' % (job.target, status(job), job.duration())
+        time.sleep(0.5)
+    return done
+
+def status(job):
+    if job.killed:
+        return 'killed, RSS above the limit'
+    return 'failed' if job.process.returncode else 'done'
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser(usage='%prog task [task ...]', description=__doc__)
+    parser.add_option('--jobs', type=int, dest='jobs', default=max(multiprocessing.cpu_count()/int(os.environ.get('megaworkers', 4)), 1),
+                      help='concurrent jobs, default: cores/megaworkers')
+    parser.add_option('--max-rss', type=float, dest='max_rss', default=None,
+                      help='resident memory limit of each job, summed over all its processes (GB)')
+    options, tasks = parser.parse_args()
+    if not tasks:
+        parser.error('at least one rake task is needed')
+
+    jobid         = os.environ['jobid']
+    runtimes_path = os.path.join('results', jobid, 'runtimes.json')
+    if not os.path.isdir(os.path.dirname(runtimes_path)):
+        os.makedirs(os.path.dirname(runtimes_path))
+    runtimes = load_runtimes(runtimes_path)
+
+    # manifests first, then the results can be made in any order
+    subprocess.check_call(['rake'] + ['sync_%s' % task for task in tasks])
+    results = task_results(tasks)
+    targets = []
+    for task in tasks:
+        for target in results.get(task, []):
+            if target not in targets:
+                targets.append(target)
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+
+    start = time.time()
+    jobs  = schedule(targets, runtimes, options.jobs, int(options.max_rss*1024**3) if options.max_rss else None)
+    makespan = time.time() - start
+
+    for job in jobs:
+        if job.ran():
+            runtimes[job.target] = job.duration()
+    save_runtimes(runtimes, runtimes_path)
+
+    print '\nmakespan: %.0f s with %i concurrent jobs' % (makespan, options.jobs)
+    for job in sorted(jobs, key=lambda i: i.duration(), reverse=True):
+        summary = 'KILLED' if job.killed else 'FAILED' if job.process.returncode else ('ran' if job.ran() else 'up to date')
+        print '%8.0f s  %8.2f GB  %-10s %s' % (job.duration(), job.peak_rss/1024.**3, summary, job.target)
+    failed = [job for job in jobs if job.process.returncode]
+    if failed:
+        print '%i job(s) failed, see the logs' % len(failed)
+        sys.exit(1)
@@ -0,0 +1,144 @@
+'''
+
+Cache of the preselected events of a sample.
+
+The first run (TAUEFF_SKIM=1) writes the events passing the preselection,
+with only the branches used after it, into <skim_dir>/<sample>_<key>/
+(one part per process, written by the columnar engine). Later runs find
+it complete and read it instead of the full ntuples, skipping the
+preselection. The key hashes the preselection and the list of input
+files (with size and modification time): changing either makes a new
+cache. The preselection is the bytecode, constants and closures of the
+cut functions, of the functions they call (helpers of the analyzer module
+too) and baseSelections as a whole: edits elsewhere in the analyzer
+(IDs, histograms) keep the cache. A cache lacking some branch needed
+(e.g. by a new histogram) is written again.
+
+'''
+
+import baseSelections
+import glob
+import hashlib
+import json
+import manifest
+import os
+import re
+import types
+import ROOT
+
+constant_types = (bool, int, long, float, str, unicode, type(None))
+
+def value_signature(value, seen):
+    'what defines a value used by a cut: functions by their code, constants by their repr'
+    if isinstance(value, types.MethodType):
+        value = value.im_func
+    if isinstance(value, types.FunctionType):
+        return function_signature(value, seen)
+    if isinstance(value, constant_types):
+        return repr(value)
+    if isinstance(value, (tuple, list)):
+        return '[%s]' % ', '.join(value_signature(i, seen) for i in value)
+    if isinstance(value, dict):
+        return '{%s}' % ', '.join('%s: %s' % (value_signature(i, seen), value_signature(j, seen)) for i, j in sorted(value.iteritems()))
+    return type(value).__name__ #modules, objects
+
+def code_signature(code):
+    'bytecode, names and constants (nested functions included), not the line numbers'
+    consts = [ code_signature(i) if isinstance(i, types.CodeType) else repr(i) for i in code.co_consts ]
+    return '%r %r [%s]' % (code.co_code, code.co_names, ', '.join(consts))
+
+def function_signature(fcn, seen):
+    '''code of fcn, values of its closure and the globals it refers to
+    (functions recursively, each once)'''
+    if fcn in seen:
+        return fcn.__name__
+    seen.add(fcn)
+    parts = [ code_signature(fcn.__code__) ]
+    if fcn.__closure__:
+        for cell in fcn.__closure__:
+            try:
+                parts.append( value_signature(cell.cell_contents, seen) )
+            except ValueError: #empty cell
+                parts.append( '<empty>' )
+    for name in fcn.__code__.co_names:
+        if name in fcn.__globals__ and not isinstance(fcn.__globals__[name], types.ModuleType):
+            parts.append( '%s=%s' % (name, value_signature(fcn.__globals__[name], seen)) )
+    return '\n'.join(parts)
+
+def preselection_signature(analyzer):
+    '''what defines the preselection of analyzer: the cuts and baseSelections
+    (the cut factories and the helpers the cuts call)'''
+    seen  = set()
+    parts = [ manifest.source_hash(os.path.splitext(baseSelections.__file__)[0] + '.py') ]
+    if analyzer.cutflow is not None:
+        for cut in analyzer.cutflow.cuts:
+            parts.extend( [cut.name, value_signature(cut.row, seen), value_signature(cut.array, seen)] )
+    else:
+        parts.extend( [value_signature(analyzer.preselection, seen), value_signature(getattr(analyzer, 'preselection_array', None), seen)] )
+    return '\n'.join(parts)
+
+def skim_origins(directory, sample):
+    '''{part : [input files]} of the complete caches of sample in directory
+    (the ones of all the analyzer instances sharing the sample)'''
+    ret = {}
+    for path in glob.glob(os.path.join(directory, '%s_*' % sample)):
+        stored_path = os.path.join(path, 'skim.json')
+        if not re.match(re.escape(sample) + '_[0-9a-f]{32}$', os.path.basename(path)) or not os.path.isfile(stored_path):
+            continue
+        with open(stored_path) as stored:
+            info = json.load(stored)
+        for part in info['parts']:
+            ret[os.path.join(path, part)] = info['inputs']
+    return ret
+
+def input_signature(files):
+    return '\n'.join( '%s %i %i' % (path, os.path.getsize(path), int(os.path.getmtime(path))) if os.path.isfile(path) else path
+                      for path in files )
+
+class SkimCache(object):
+    tree_name = 'skim'
+    def __init__(self, directory, sample, analyzer, files):
+        key = hashlib.md5(preselection_signature(analyzer) + '\n' + input_signature(files)).hexdigest()
+        self.path     = os.path.join(directory, '%s_%s' % (sample, key))
+        self.manifest = os.path.join(self.path, 'skim.json')
+        self.inputs   = files
+
+    def complete(self):
+        return os.path.isfile(self.manifest)
+
+    def branches(self):
+        'the branches stored, None if the cache is not complete'
+        if not self.complete():
+            return None
+        with open(self.manifest) as stored:
+            return json.load(stored)['branches']
+
+    def parts(self):
+        return sorted(glob.glob(os.path.join(self.path, 'part_*.root')))
+
+    def open(self):
+        chain = ROOT.TChain(self.tree_name)
+        for path in self.parts():
+            chain.Add(path)
+        return chain
+
+    def prepare(self):
+        'makes the directory, removing the parts of a previous attempt'
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        if self.complete():
+            os.remove(self.manifest)
+        for path in self.parts():
+            os.remove(path)
+
+    def part_path(self, start):
+        'file of the part starting at entry start'
+        return os.path.join(self.path, 'part_%012i.root' % start)
+
+    def seal(self, branches):
+        'marks the cache as complete'
+        tmp_path = self.manifest + '.tmp'
+        with open(tmp_path, 'w') as stored:
+            json.dump({'branches' : branches, 'inputs' : self.inputs, 'parts' : [os.path.basename(i) for i in self.parts()]},
+                      stored, indent=2)
+        os.rename(tmp_path, self.manifest)